@@ -8,24 +8,42 @@ Merge NetCDF files from /sat_data/icon layout.
 - Groups files by icon type and init time
 - Concatenates files per variable, then merges all variables into one dataset
 - Saves merged files with compression in: /sat_data/icon/icon_*/merged_nc/
+- With n_workers > 1 the groups are merged concurrently in a process pool
+  (each group's log is printed as one block when it finishes)
+- Compression defaults to zlib level 9 with shuffle; override with the
+  environment variables MERGE_CODEC (none, zlib, zstd, bzip2, szip, blosc_*),
+  MERGE_COMPLEVEL, MERGE_SHUFFLE (0/1) and MERGE_CHUNKS (e.g. time=1,lat=256,lon=256).
+  The settings are parsed and validated by teamx/nc_encoding.py, like the teamx
+  merge; teamx/benchmark_nc_encodings.py compares candidates on a merged day.
 
 Usage:
-    python 3_merge_nc_files.py [date] [sat_base]
+    python 3_merge_nc_files.py [date] [sat_base] [n_workers]
 
 Examples:
     python 3_merge_nc_files.py
     python 3_merge_nc_files.py 2026-03-31
     python 3_merge_nc_files.py 2026-03-31 /sat_data/icon
+    python 3_merge_nc_files.py 2026-03-31 /sat_data/icon 4
 """
 
 import os
 import glob
 import sys
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import numpy as np
 import xarray as xr
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "teamx"))
+from nc_encoding import compression_options, compression_options_from_env, dataset_encoding, describe
+
+# Unlike the teamx merge (256x256 tiles per time step, sized for the crop
+# generator's reads), the icon_d2/icon_eu files are not read window by window,
+# so they keep the library's chunking unless MERGE_CHUNKS is set.
+DEFAULT_CHUNKS = ""
+DEFAULT_COMPRESSION = compression_options(chunks=DEFAULT_CHUNKS)
+
 
 def deduplicate_time(ds):
     """Keep first occurrence of duplicate timestamps, preserving order."""
@@ -40,7 +58,128 @@ def deduplicate_time(ds):
     return ds.isel(time=unique_idx)
 
 
-def merge_nc_files_by_init(target_date="2026-03-31", sat_base="/sat_data/icon"):
+def merge_group(icon_type, init_time, var_groups, target_date, sat_base, compression=DEFAULT_COMPRESSION, log=print):
+    """
+    Concatenate and merge the files of one (icon type, init) group and save
+    the compressed merged file. `var_groups` maps variable name -> NC files.
+    Returns True when the merged file was written.
+    """
+    all_opened = []
+    per_var_datasets = []
+
+    log("")
+    log(
+        f"Merging {icon_type} init={init_time} "
+        f"({len(var_groups)} variables)"
+    )
+
+    try:
+        for var_name, nc_files in sorted(var_groups.items()):
+            log(f"  Variable {var_name}: {len(nc_files)} files")
+
+            datasets = []
+            for nc_file in sorted(nc_files):
+                try:
+                    ds = xr.open_dataset(nc_file)
+                    datasets.append(ds)
+                    all_opened.append(ds)
+                except Exception as e:
+                    log(f"    Error reading {os.path.basename(nc_file)}: {e}")
+                    continue
+
+            if not datasets:
+                log(f"    Warning: no readable files for variable {var_name}, skipping")
+                continue
+
+            merge_dim = "time" if "time" in datasets[0].dims else None
+            if merge_dim is None:
+                merge_dim = list(datasets[0].dims)[0] if datasets[0].dims else None
+
+            if merge_dim:
+                var_ds = xr.concat(datasets, dim=merge_dim)
+                log(f"    ✓ Concatenated on '{merge_dim}'")
+            else:
+                var_ds = datasets[0]
+                log("    ⓘ No concat dimension found, using first file")
+
+            if "time" in var_ds.dims:
+                before_count = int(var_ds.sizes["time"])
+                var_ds = deduplicate_time(var_ds)
+                after_count = int(var_ds.sizes["time"])
+                if after_count != before_count:
+                    log(f"    ⓘ Removed duplicate time entries: {before_count} -> {after_count}")
+
+            per_var_datasets.append(var_ds)
+
+        if not per_var_datasets:
+            log(f"  ERROR: No valid variable datasets for {icon_type} init={init_time}")
+            return False
+
+        # Keep full union of timestamps across variables.
+        # Variables that do not have a given timestamp will contain NaN there.
+        time_datasets = [ds for ds in per_var_datasets if "time" in ds.dims]
+        if time_datasets:
+            union_times = np.unique(np.concatenate([ds_t["time"].values for ds_t in time_datasets]))
+            log(f"  Union time steps across variables: {len(union_times)}")
+
+        merged_ds = xr.merge(per_var_datasets, join="outer", compat="override")
+        log("  ✓ Merged all variables into a single dataset")
+
+        # Define output file
+        output_dir = os.path.join(sat_base, icon_type, "merged_nc")
+        os.makedirs(output_dir, exist_ok=True)
+        output_file = os.path.join(
+            output_dir,
+            f"merged_{icon_type}_init{init_time}_{target_date}.nc"
+        )
+
+        # Save with compression
+        encoding = dataset_encoding(merged_ds, compression)
+
+        merged_ds.to_netcdf(
+            output_file,
+            encoding=encoding,
+            unlimited_dims=["time"] if "time" in merged_ds.dims else None
+        )
+        merged_ds.close()
+
+        for ds in per_var_datasets:
+            ds.close()
+        for ds in all_opened:
+            ds.close()
+
+        file_size_mb = os.path.getsize(output_file) / (1024**2)
+        log(f"  ✓ Saved: {os.path.basename(output_file)} ({file_size_mb:.2f} MB)")
+        return True
+
+    except Exception as e:
+        log(
+            f"  ERROR: Failed to merge {icon_type} "
+            f"init={init_time}: {e}"
+        )
+
+        for ds in per_var_datasets:
+            try:
+                ds.close()
+            except Exception:
+                pass
+        for ds in all_opened:
+            try:
+                ds.close()
+            except Exception:
+                pass
+
+        return False
+
+
+def _merge_group_logged(icon_type, init_time, var_groups, target_date, sat_base, compression):
+    """Pool worker: merge_group with its log collected, so groups do not interleave their output."""
+    log_lines = []
+    ok = merge_group(icon_type, init_time, var_groups, target_date, sat_base, compression, log=log_lines.append)
+    return ok, log_lines
+
+
+def merge_nc_files_by_init(target_date="2026-03-31", sat_base="/sat_data/icon", n_workers=1, compression=None):
     """
     Merge NC files grouped by icon type and init time.
     
@@ -50,13 +189,21 @@ def merge_nc_files_by_init(target_date="2026-03-31", sat_base="/sat_data/icon"):
         Date folder to process (format: YYYY-MM-DD)
     sat_base : str
         Base sat_data path containing icon_* directories
+    n_workers : int
+        Processes merging groups concurrently (1 = one group after another)
+    compression : dict
+        Output compression from nc_encoding.compression_options (default DEFAULT_COMPRESSION)
     """
+    if compression is None:
+        compression = DEFAULT_COMPRESSION
     
     print("=" * 70)
     print("NetCDF File Merger (/sat_data/icon layout)")
     print("=" * 70)
     print(f"Date:        {target_date}")
     print(f"Sat base:    {sat_base}")
+    print(f"Workers:     {n_workers}")
+    print(f"Compression: {describe(compression)}")
     print()
 
     # Dictionary to track files by (icon_type, init_time) and variable name
@@ -97,121 +244,33 @@ def merge_nc_files_by_init(target_date="2026-03-31", sat_base="/sat_data/icon"):
             groups[key][var_name].append(nc_file)
 
     # Process each group
-    total_merged = 0
-    failed_groups = 0
-
-    for (icon_type, init_time), var_groups in sorted(groups.items()):
-        print()
-        print(
-            f"Merging {icon_type} init={init_time} "
-            f"({len(var_groups)} variables)"
-        )
-
-        all_opened = []
-        per_var_datasets = []
-
-        try:
-            for var_name, nc_files in sorted(var_groups.items()):
-                print(f"  Variable {var_name}: {len(nc_files)} files")
-
-                datasets = []
-                for nc_file in sorted(nc_files):
-                    try:
-                        ds = xr.open_dataset(nc_file)
-                        datasets.append(ds)
-                        all_opened.append(ds)
-                    except Exception as e:
-                        print(f"    Error reading {os.path.basename(nc_file)}: {e}")
-                        continue
-
-                if not datasets:
-                    print(f"    Warning: no readable files for variable {var_name}, skipping")
-                    continue
-
-                merge_dim = "time" if "time" in datasets[0].dims else None
-                if merge_dim is None:
-                    merge_dim = list(datasets[0].dims)[0] if datasets[0].dims else None
-
-                if merge_dim:
-                    var_ds = xr.concat(datasets, dim=merge_dim)
-                    print(f"    ✓ Concatenated on '{merge_dim}'")
-                else:
-                    var_ds = datasets[0]
-                    print("    ⓘ No concat dimension found, using first file")
-
-                if "time" in var_ds.dims:
-                    before_count = int(var_ds.sizes["time"])
-                    var_ds = deduplicate_time(var_ds)
-                    after_count = int(var_ds.sizes["time"])
-                    if after_count != before_count:
-                        print(f"    ⓘ Removed duplicate time entries: {before_count} -> {after_count}")
-
-                per_var_datasets.append(var_ds)
-
-            if not per_var_datasets:
-                print(f"  ERROR: No valid variable datasets for {icon_type} init={init_time}")
-                failed_groups += 1
-                continue
-
-            # Keep full union of timestamps across variables.
-            # Variables that do not have a given timestamp will contain NaN there.
-            time_datasets = [ds for ds in per_var_datasets if "time" in ds.dims]
-            if time_datasets:
-                union_times = np.unique(np.concatenate([ds_t["time"].values for ds_t in time_datasets]))
-                print(f"  Union time steps across variables: {len(union_times)}")
-
-            merged_ds = xr.merge(per_var_datasets, join="outer", compat="override")
-            print("  ✓ Merged all variables into a single dataset")
-
-            # Define output file
-            output_dir = os.path.join(sat_base, icon_type, "merged_nc")
-            os.makedirs(output_dir, exist_ok=True)
-            output_file = os.path.join(
-                output_dir,
-                f"merged_{icon_type}_init{init_time}_{target_date}.nc"
-            )
-
-            # Save with compression
-            encoding = {
-                var_name: {"zlib": True, "complevel": 9}
-                for var_name in merged_ds.data_vars
+    groups = [(key, dict(var_groups)) for key, var_groups in sorted(groups.items())]
+    results = []
+
+    if n_workers > 1 and len(groups) > 1:
+        print(f"Merging {len(groups)} groups on {min(n_workers, len(groups))} processes")
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(groups))) as pool:
+            futures = {
+                pool.submit(
+                    _merge_group_logged, icon_type, init_time, var_groups, target_date, sat_base, compression,
+                ): (icon_type, init_time)
+                for (icon_type, init_time), var_groups in groups
             }
-
-            merged_ds.to_netcdf(
-                output_file,
-                encoding=encoding,
-                unlimited_dims=["time"] if "time" in merged_ds.dims else None
-            )
-            merged_ds.close()
-
-            for ds in per_var_datasets:
-                ds.close()
-            for ds in all_opened:
-                ds.close()
-
-            file_size_mb = os.path.getsize(output_file) / (1024**2)
-            print(f"  ✓ Saved: {os.path.basename(output_file)} ({file_size_mb:.2f} MB)")
-            total_merged += 1
-
-        except Exception as e:
-            print(
-                f"  ERROR: Failed to merge {icon_type} "
-                f"init={init_time}: {e}"
-            )
-
-            for ds in per_var_datasets:
-                try:
-                    ds.close()
-                except Exception:
-                    pass
-            for ds in all_opened:
+            for future in as_completed(futures):
+                icon_type, init_time = futures[future]
                 try:
-                    ds.close()
-                except Exception:
-                    pass
-
-            failed_groups += 1
-            continue
+                    ok, log_lines = future.result()
+                except Exception as e:
+                    ok, log_lines = False, ["", f"  ERROR: Worker failed for {icon_type} init={init_time}: {e}"]
+                # Each group's log is printed as one block when it finishes.
+                print("\n".join(log_lines))
+                results.append(ok)
+    else:
+        for (icon_type, init_time), var_groups in groups:
+            results.append(merge_group(icon_type, init_time, var_groups, target_date, sat_base, compression))
+
+    total_merged = sum(results)
+    failed_groups = len(results) - total_merged
 
     # Summary
     print()
@@ -233,6 +292,13 @@ def merge_nc_files_by_init(target_date="2026-03-31", sat_base="/sat_data/icon"):
 if __name__ == "__main__":
     date_arg = sys.argv[1] if len(sys.argv) > 1 else "2026-03-31"
     sat_base_arg = sys.argv[2] if len(sys.argv) > 2 else "/sat_data/icon"
+    n_workers_arg = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+
+    try:
+        compression_arg = compression_options_from_env(chunks=DEFAULT_CHUNKS)
+    except ValueError as e:
+        print(f"ERROR: invalid MERGE_* compression settings: {e}")
+        sys.exit(1)
 
-    success = merge_nc_files_by_init(date_arg, sat_base_arg)
+    success = merge_nc_files_by_init(date_arg, sat_base_arg, n_workers_arg, compression_arg)
     sys.exit(0 if success else 1)
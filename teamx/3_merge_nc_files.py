@@ -4,6 +4,20 @@ Merge NC files and extract a specific variable.
 
 Reads NC files from a directory, extracts SYNMSG_BT_CL_IR10.8 variable,
 merges all files, and saves to output directory.
+
+By default the merge is streamed: the output is created with an unlimited time
+dimension and the input files are appended one at a time, so memory stays at
+one hourly slab whatever the number of hours. Set MERGE_STREAMING=0 to use the
+former in-memory xr.concat merge.
+
+With MERGE_APPEND=1 an existing merged file is updated in place of a rebuild:
+only time steps missing from its time coordinate are read from the inputs and
+inserted, keeping time sorted and free of duplicates.
+
+Compression defaults to zlib level 9 with shuffle, chunked per time step in
+256x256 lat/lon tiles to match the per-hour crop reads; MERGE_CODEC,
+MERGE_COMPLEVEL, MERGE_SHUFFLE and MERGE_CHUNKS override it (see nc_encoding.py,
+and benchmark_nc_encodings.py to compare candidates on a merged day).
 """
 
 import os
@@ -15,9 +29,224 @@ from pathlib import Path
 
 import xarray as xr
 import numpy as np
+import netCDF4
+from xarray.coding.times import encode_cf_datetime
+
+from nc_encoding import compression_options, compression_options_from_env, dataset_encoding, describe
+
+# Default time units when the inputs carry none (e.g. files written by xarray).
+DEFAULT_TIME_UNITS = "seconds since 1970-01-01 00:00:00"
+
+
+def _time_encoding(ds):
+    """units/calendar of the time coordinate in the input files, kept in the merged file."""
+    enc = ds["time"].encoding
+    return {
+        "units": enc.get("units", DEFAULT_TIME_UNITS),
+        "calendar": enc.get("calendar", "proleptic_gregorian"),
+        "dtype": enc.get("dtype", np.dtype("float64")),
+    }
+
+
+def create_streaming_output(nc_files, var_list, output_file, compression):
+    """
+    Create `output_file` with an empty, unlimited time dimension.
+
+    Each requested variable is laid out as in the first input file that holds
+    it; static coordinates (lat, lon, ...) are written here once.
+    """
+    template_parts = []
+    time_encoding = None
+    remaining = list(var_list)
+    for nc_file in nc_files:
+        if not remaining:
+            break
+        with xr.open_dataset(nc_file) as ds:
+            found = [v for v in remaining if v in ds.data_vars]
+            if not found:
+                continue
+            if time_encoding is None:
+                time_encoding = _time_encoding(ds)
+            template_parts.append(ds[found].isel(time=slice(0, 0)).load())
+            remaining = [v for v in remaining if v not in found]
+
+    template = xr.merge(template_parts, compat="override", join="override")
+    template = template[[v for v in var_list if v in template.data_vars]]
+
+    encoding = dataset_encoding(template, compression)
+    encoding["time"] = time_encoding
+    template.to_netcdf(output_file, encoding=encoding, unlimited_dims=["time"])
+
+
+def append_time_slab(nc, nc_file, var_list):
+    """
+    Append the time steps of one input file to the open netCDF4 output `nc`.
+
+    Variables are read and written one at a time; time-dependent coordinates
+    are appended with them, datetimes encoded with the units of the output.
+    Returns the number of time steps appended.
+    """
+    n0 = len(nc.dimensions["time"])
+    with xr.open_dataset(nc_file) as ds:
+        n1 = n0 + ds.sizes["time"]
+        names = ["time"] + [v for v in var_list if v in ds.data_vars]
+        names += [c for c in ds.coords if c not in names and "time" in ds[c].dims and c in nc.variables]
+        for name in names:
+            out_var = nc[name]
+            values = ds[name].transpose(*out_var.dimensions).values
+            if np.issubdtype(values.dtype, np.datetime64):
+                values, _, _ = encode_cf_datetime(
+                    values, out_var.units, getattr(out_var, "calendar", None), dtype=out_var.dtype,
+                )
+            out_var[n0:n1] = values
+    return n1 - n0
+
+
+def stream_merge_nc_files(nc_files, var_list, output_file, compression):
+    """Merge `nc_files` along time into `output_file`, holding one input file in memory at a time."""
+    tmp_file = f"{output_file}.tmp"
+    create_streaming_output(nc_files, var_list, tmp_file, compression)
+    with netCDF4.Dataset(tmp_file, "a") as nc:
+        for nc_file in nc_files:
+            append_time_slab(nc, nc_file, var_list)
+        n_time = len(nc.dimensions["time"])
+    os.replace(tmp_file, output_file)
+    return n_time
+
+
+def _time_values(nc_file):
+    with xr.open_dataset(nc_file) as ds:
+        return ds["time"].values
+
+
+def _time_keys(times):
+    return np.asarray(times, dtype="datetime64[ns]").astype("int64")
 
 
-def merge_nc_files(input_dir, output_dir, variable_name=["SYNMSG_BT_CL_IR10.8"], date="20250401_00"):
+def append_merge_nc_files(nc_files, var_list, output_file):
+    """
+    Add to the merged `output_file` the time steps of `nc_files` it does not hold yet.
+
+    Duplicate timestamps keep their first occurrence (existing file first, then
+    inputs in file order), as deduplicate_time does. New steps after the last
+    stored time are appended; earlier ones are inserted by moving only the later
+    steps one slab at a time, so the steps before the first insertion are never
+    re-read or recompressed. The update runs on a copy that replaces the file
+    at the end. Returns (steps added, total steps).
+    """
+    existing = _time_values(output_file)
+    if np.any(np.diff(_time_keys(existing)) <= 0):
+        raise ValueError(f"Time in {output_file} is not sorted and unique; rerun the merge without append")
+
+    seen = set(_time_keys(existing).tolist())
+    new_steps = []
+    for nc_file in nc_files:
+        times = _time_values(nc_file)
+        for i, key in enumerate(_time_keys(times).tolist()):
+            if key not in seen:
+                seen.add(key)
+                new_steps.append((key, nc_file, i))
+    if not new_steps:
+        return 0, existing.size
+
+    # Positions from `first` on are rewritten in time order, old and new steps interleaved.
+    new_steps.sort()
+    existing_keys = _time_keys(existing)
+    first = int(np.searchsorted(existing_keys, new_steps[0][0]))
+    tail = sorted(
+        [(key, None, j) for j, key in enumerate(existing_keys[first:].tolist(), start=first)] + new_steps
+    )
+
+    tmp_file = f"{output_file}.tmp"
+    shutil.copyfile(output_file, tmp_file)
+    opened = {}
+    try:
+        with netCDF4.Dataset(tmp_file, "a") as nc:
+            names = [name for name, var in nc.variables.items() if var.dimensions[:1] == ("time",)]
+            # Walk backwards: an old step only ever moves to a later position, so
+            # every source slab is read before its position is overwritten.
+            for pos in range(first + len(tail) - 1, first - 1, -1):
+                _, nc_file, index = tail[pos - first]
+                if nc_file is None:
+                    for name in names:
+                        nc[name][pos] = nc[name][index]
+                    continue
+                if nc_file not in opened:
+                    opened[nc_file] = xr.open_dataset(nc_file)
+                ds = opened[nc_file]
+                for name in names:
+                    out_var = nc[name]
+                    if name not in ds.variables:
+                        out_var[pos] = np.ma.masked_all(out_var.shape[1:], dtype=out_var.dtype)
+                        continue
+                    values = ds[name].isel(time=index).transpose(*out_var.dimensions[1:]).values
+                    if np.issubdtype(values.dtype, np.datetime64):
+                        values, _, _ = encode_cf_datetime(
+                            values, out_var.units, getattr(out_var, "calendar", None), dtype=out_var.dtype,
+                        )
+                    out_var[pos] = values
+            n_time = len(nc.dimensions["time"])
+    finally:
+        for ds in opened.values():
+            ds.close()
+    os.replace(tmp_file, output_file)
+    return len(new_steps), n_time
+
+
+def write_concat_merge(datasets_with_var, var_list, output_file, compression):
+    """In-memory merge: xr.concat of all opened datasets, then one write."""
+    print("Merging datasets...")
+    
+    # Extract requested variables that exist in each dataset
+    data_vars = []
+    for ds in datasets_with_var:
+        # Keep only the variables that exist in this dataset
+        existing_vars = [v for v in var_list if v in ds.data_vars]
+        if existing_vars:
+            var_data = ds[existing_vars]
+            data_vars.append(var_data)
+    
+    # Merge along the first available dimension
+    try:
+        # Try to merge along time dimension (common for climate/weather data)
+        if "time" in data_vars[0].dims:
+            merged_ds = xr.concat(data_vars, dim="time")
+            print(f"✓ Merged along 'time' dimension")
+        else:
+            # Get first dimension
+            first_dim = list(data_vars[0].dims)[0]
+            merged_ds = xr.concat(data_vars, dim=first_dim)
+            print(f"✓ Merged along '{first_dim}' dimension")
+    except Exception as e:
+        print(f"ERROR: Failed to merge datasets: {e}")
+        return False
+    
+    # Close all opened datasets
+    for ds in datasets_with_var:
+        ds.close()
+    
+    print()
+    print(f"Saving merged file: {output_file}")
+    
+    try:
+        encoding = dataset_encoding(merged_ds, compression)
+
+        merged_ds.to_netcdf(
+            output_file,
+            encoding=encoding,
+            unlimited_dims=['time'] if 'time' in merged_ds.dims else None
+        )
+        merged_ds.close()
+        print(f"✓ File saved successfully ({describe(compression)})")
+    except Exception as e:
+        print(f"ERROR: Failed to save file: {e}")
+        return False
+
+    return True
+
+
+def merge_nc_files(input_dir, output_dir, variable_name=["SYNMSG_BT_CL_IR10.8"], date="20250401_00", streaming=True,
+                   compression=None, append=False):
     """
     Merge NC files and extract specific variable(s).
     
@@ -30,6 +259,15 @@ def merge_nc_files(input_dir, output_dir, variable_name=["SYNMSG_BT_CL_IR10.8"],
     variable_name : str or list
         Variable name(s) to extract (comma-separated string or list)
         Example: "SYNMSG_BT_CL_IR10.8" or "SYNMSG_BT_CL_IR10.8,CLCT" or ["SYNMSG_BT_CL_IR10.8", "CLCT"]
+    streaming : bool
+        Append the files one at a time to the output (bounded memory) instead of
+        concatenating all of them in memory. Needs a time dimension in the files.
+    compression : dict
+        Output compression from nc_encoding.compression_options
+        (default zlib level 9, shuffle, time=1 x 256 x 256 chunks)
+    append : bool
+        If the merged file already exists, only add the time steps it is missing
+        (its own compression settings are kept); otherwise merge as usual.
     """
     
     # Parse comma-separated variable names or accept list directly
@@ -37,6 +275,8 @@ def merge_nc_files(input_dir, output_dir, variable_name=["SYNMSG_BT_CL_IR10.8"],
         var_list = variable_name
     else:
         var_list = [v.strip() for v in variable_name.split(',')]
+    if compression is None:
+        compression = compression_options()
     
     print("=" * 60)
     print("NC File Merger")
@@ -44,6 +284,7 @@ def merge_nc_files(input_dir, output_dir, variable_name=["SYNMSG_BT_CL_IR10.8"],
     print(f"Input directory:  {input_dir}")
     print(f"Output directory: {output_dir}")
     print(f"Variables:        {', '.join(var_list)}")
+    print(f"Compression:      {describe(compression)}")
     print()
     
     # Check input directory exists
@@ -78,7 +319,17 @@ def merge_nc_files(input_dir, output_dir, variable_name=["SYNMSG_BT_CL_IR10.8"],
             found_vars = [v for v in var_list if v in ds.data_vars]
             
             if found_vars:
-                datasets_with_var.append(ds)
+                if streaming and "time" not in ds.dims:
+                    print(f"ⓘ {filename} has no time dimension, falling back to in-memory merge")
+                    streaming = False
+                    for ds_streamed in datasets_with_var:
+                        ds_streamed.close()
+                    datasets_with_var = [xr.open_dataset(os.path.join(input_dir, f)) for f in files_with_var]
+                if streaming:
+                    # Only the file list is kept; files are reopened one at a time while merging.
+                    ds.close()
+                else:
+                    datasets_with_var.append(ds)
                 files_with_var.append(filename)
                 print(f"✓ {filename} - Contains: {', '.join(found_vars)}")
             else:
@@ -94,66 +345,40 @@ def merge_nc_files(input_dir, output_dir, variable_name=["SYNMSG_BT_CL_IR10.8"],
     print(f"Found variable in {len(files_with_var)} files")
     print(f"Skipped {len(files_skipped)} files")
     
-    if not datasets_with_var:
+    if not files_with_var:
         print("\nERROR: No files contain the variable!")
         return False
     
-    print()
-    print("Merging datasets...")
-    
-    # Extract requested variables that exist in each dataset
-    data_vars = []
-    for ds in datasets_with_var:
-        # Keep only the variables that exist in this dataset
-        existing_vars = [v for v in var_list if v in ds.data_vars]
-        if existing_vars:
-            var_data = ds[existing_vars]
-            data_vars.append(var_data)
-    
-    # Merge along the first available dimension
-    try:
-        # Try to merge along time dimension (common for climate/weather data)
-        if "time" in data_vars[0].dims:
-            merged_ds = xr.concat(data_vars, dim="time")
-            print(f"✓ Merged along 'time' dimension")
-        else:
-            # Get first dimension
-            first_dim = list(data_vars[0].dims)[0]
-            merged_ds = xr.concat(data_vars, dim=first_dim)
-            print(f"✓ Merged along '{first_dim}' dimension")
-    except Exception as e:
-        print(f"ERROR: Failed to merge datasets: {e}")
-        return False
-    
-    # Close all opened datasets
-    for ds in datasets_with_var:
-        ds.close()
-    
     # Create output filename
     var_suffix = '_'.join(var_list) if len(var_list) <= 3 else f"{len(var_list)}vars"
     output_file = os.path.join(output_dir, f"merged_{var_suffix}_{date}.nc")
-    
-    print()
-    print(f"Saving merged file: {output_file}")
-    
-    try:
-        # Apply zlib compression (level 9) to all data variables in the output NetCDF.
-        encoding = {
-            var_name: {"zlib": True, "complevel": 9}
-            for var_name in merged_ds.data_vars
-        }
 
-        merged_ds.to_netcdf(
-            output_file,
-            encoding=encoding,
-            unlimited_dims=['time'] if 'time' in merged_ds.dims else None
-        )
-        merged_ds.close()
-        print("✓ File saved successfully with zlib compression (level 9)")
-    except Exception as e:
-        print(f"ERROR: Failed to save file: {e}")
+    print()
+    if append and os.path.exists(output_file):
+        print(f"Appending missing time steps to: {output_file}")
+        try:
+            n_new, n_time = append_merge_nc_files(
+                [os.path.join(input_dir, f) for f in files_with_var], var_list, output_file,
+            )
+            print(f"✓ Added {n_new} new time steps, {n_time} in total")
+        except Exception as e:
+            print(f"ERROR: Failed to append to merged file: {e}")
+            return False
+    elif streaming:
+        if append:
+            print("ⓘ No merged file yet, running a full merge")
+        print(f"Streaming merge into: {output_file}")
+        try:
+            n_time = stream_merge_nc_files(
+                [os.path.join(input_dir, f) for f in files_with_var], var_list, output_file, compression,
+            )
+            print(f"✓ Appended {len(files_with_var)} files, {n_time} time steps")
+            print(f"✓ File saved successfully ({describe(compression)})")
+        except Exception as e:
+            print(f"ERROR: Failed to merge datasets: {e}")
+            return False
+    elif not write_concat_merge(datasets_with_var, var_list, output_file, compression):
         return False
-
     # # Also create a gzip-compressed copy (.nc.gz) while keeping the .nc file.
     # gz_output_file = f"{output_file}.gz"
     # try:
@@ -211,6 +436,11 @@ if __name__ == "__main__":
     if len(sys.argv) > 4:
         VARIABLE = sys.argv[4]
     
+    STREAMING = os.environ.get("MERGE_STREAMING", "1") != "0"
+    COMPRESSION = compression_options_from_env()
+    APPEND = os.environ.get("MERGE_APPEND", "0") == "1"
+
     print(f"Processing date: {DATE}")
-    success = merge_nc_files(INPUT_DIR, OUTPUT_DIR, VARIABLE, DATE)
+    success = merge_nc_files(INPUT_DIR, OUTPUT_DIR, VARIABLE, DATE, streaming=STREAMING, compression=COMPRESSION,
+                             append=APPEND)
     sys.exit(0 if success else 1)
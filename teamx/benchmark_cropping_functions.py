@@ -0,0 +1,92 @@
+"""
+Micro-benchmark of the index-based filter_by_domain / filter_by_time against
+label-based xarray selection (the behaviour of the former external helpers).
+
+A synthetic day cube on the ICON regular grid is cropped to every domain at
+every hour, three ways:
+  - label:   ds.sel(time=t) then ds.sel(lon=slice(...), lat=slice(...))
+  - index:   filter_by_time / filter_by_domain (searchsorted on every call)
+  - reused:  filter_by_domain with the domain_slices computed once per day
+All three must give identical crops.
+
+Usage:
+    python benchmark_cropping_functions.py --repeat 5
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from cropping_functions import domain_slices, filter_by_domain, filter_by_time
+
+DOMAINS = {
+    'central': (9.0, 13.0, 45.0, 49.0),
+    'west': (7.0, 11.0, 45.0, 49.0),
+    'east': (11.0, 15.0, 45.0, 49.0),
+}
+
+
+def make_day_cube(n_time=24, resolution=0.01):
+    lon = np.round(np.arange(5.0, 17.0, resolution), 6)
+    lat = np.round(np.arange(43.0, 51.0, resolution), 6)
+    times = pd.date_range('2025-04-01 01:00', periods=n_time, freq='1h')
+    rng = np.random.default_rng(0)
+    data = rng.uniform(180, 320, (n_time, lat.size, lon.size)).astype('float32')
+    return xr.Dataset(
+        {'SYNMSG_BT_CL_IR10.8': (('time', 'lat', 'lon'), data)},
+        coords={'time': times, 'lat': lat, 'lon': lon},
+    )
+
+
+def label_crop(ds, timestamp, extent):
+    lonmin, lonmax, latmin, latmax = extent
+    return ds.sel(time=timestamp).sel(lon=slice(lonmin, lonmax), lat=slice(latmin, latmax))
+
+
+def index_crop(ds, timestamp, extent):
+    return filter_by_domain(filter_by_time(ds, timestamp), extent)
+
+
+def time_crops(ds, crop_fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for timestamp in ds.time.values:
+            for extent in DOMAINS.values():
+                crop_fn(ds, timestamp, extent).load()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark label- vs index-based crop selection.")
+    parser.add_argument('--n-time', type=int, default=24, help="Timesteps in the synthetic day cube")
+    parser.add_argument('--resolution', type=float, default=0.01, help="Grid spacing in degrees")
+    parser.add_argument('--repeat', type=int, default=5, help="Timing repetitions (best is reported)")
+    args = parser.parse_args()
+
+    ds = make_day_cube(args.n_time, args.resolution)
+    slices = {name: domain_slices(ds.lon.values, ds.lat.values, extent) for name, extent in DOMAINS.items()}
+
+    def reused_crop(ds, timestamp, extent):
+        name = next(n for n, e in DOMAINS.items() if e == extent)
+        return filter_by_domain(filter_by_time(ds, timestamp), extent, slices[name])
+
+    for timestamp in ds.time.values:
+        for extent in DOMAINS.values():
+            ref = label_crop(ds, timestamp, extent)
+            for crop_fn in (index_crop, reused_crop):
+                if not ref.identical(crop_fn(ds, timestamp, extent)):
+                    raise AssertionError(f"{crop_fn.__name__} differs from label selection at {timestamp} {extent}")
+
+    n_crops = ds.sizes['time'] * len(DOMAINS)
+    print(f"Grid {ds.sizes['lat']}x{ds.sizes['lon']}, {n_crops} crops per pass, best of {args.repeat}")
+    for label, crop_fn in (('label', label_crop), ('index', index_crop), ('reused', reused_crop)):
+        elapsed = time_crops(ds, crop_fn, args.repeat)
+        print(f"  {label:<7} {elapsed * 1e3:8.1f} ms  ({elapsed / n_crops * 1e6:7.1f} us/crop)")
+
+
+if __name__ == "__main__":
+    main()
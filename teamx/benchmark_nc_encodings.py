@@ -0,0 +1,172 @@
+"""
+Compare NetCDF compression settings on a sample merged day file.
+
+Each candidate re-writes the data variables of the sample with one encoding
+and reports write time, full read time, the read time of one time step, the
+read time of one time step over a crop-sized window (what the crop generator
+does per hour and domain) and the file size.
+
+Candidates are codec[:complevel[:shuffle|noshuffle[:chunks]]], e.g.
+    zlib:9  zlib:4  zlib:1:noshuffle  zstd:3  none  zlib:4:shuffle:time=1,lat=256,lon=256
+
+Usage:
+    python benchmark_nc_encodings.py /sat_data/icon_teamx/nc_tmp/20250401_00/merged_SYNMSG_BT_CL_IR10.8_CLCT_20250401_00.nc
+    python benchmark_nc_encodings.py sample.nc --candidates zlib:9 zlib:4 zstd:3 --repeat 3 --csv encodings.csv
+    python benchmark_nc_encodings.py sample.nc --candidates zlib:9::shuffle: zlib:9:shuffle:time=1,lat=256,lon=256 --crop-pixels 800
+"""
+import os
+import csv
+import time
+import argparse
+import tempfile
+
+import xarray as xr
+import netCDF4
+
+from nc_encoding import DEFAULT_CHUNKS, compression_options, dataset_encoding, describe
+
+DEFAULT_CANDIDATES = [
+    'zlib:9', 'zlib:4', 'zlib:1', 'zlib:4:noshuffle', 'zstd:3', 'none',
+    'zlib:9:shuffle:', 'zlib:4:shuffle:time=1,lat=512,lon=512',
+]
+
+# Codecs that need HDF5 filter plugins which the local netCDF4 build may lack.
+_CODEC_SUPPORT = {
+    'zstd': '__has_zstandard_support__',
+    'bzip2': '__has_bzip2_support__',
+    'szip': '__has_szip_support__',
+    'blosc_lz4': '__has_blosc_support__',
+    'blosc_lz': '__has_blosc_support__',
+    'blosc_zlib': '__has_blosc_support__',
+    'blosc_zstd': '__has_blosc_support__',
+}
+
+
+def parse_candidate(spec):
+    """
+    codec[:complevel[:shuffle|noshuffle[:chunks]]] -> compression options.
+    Without a chunks field the merge default (DEFAULT_CHUNKS) is used; an empty
+    one ('zlib:9:shuffle:') leaves chunking to the netCDF library.
+    """
+    parts = spec.split(':')
+    codec = parts[0]
+    complevel = int(parts[1]) if len(parts) > 1 and parts[1] else 4
+    shuffle = not (len(parts) > 2 and parts[2] == 'noshuffle')
+    chunks = parts[3] if len(parts) > 3 else DEFAULT_CHUNKS
+    return compression_options(codec, complevel, shuffle, chunks)
+
+
+def codec_available(codec):
+    flag = _CODEC_SUPPORT.get(codec)
+    return flag is None or bool(getattr(netCDF4, flag, 0))
+
+
+def crop_window(ds, crop_pixels):
+    """isel indexers of one middle time step over a centred crop_pixels x crop_pixels lat/lon window."""
+    window = {}
+    if 'time' in ds.dims:
+        window['time'] = ds.sizes['time'] // 2
+    for dim in ('lat', 'lon'):
+        if dim in ds.dims:
+            size = min(crop_pixels, ds.sizes[dim])
+            start = (ds.sizes[dim] - size) // 2
+            window[dim] = slice(start, start + size)
+    return window
+
+
+def benchmark_candidate(ds, options, out_dir, repeat, crop_pixels):
+    """
+    Best-of-`repeat` (write s, read s, one-step read s, crop read s) and size in
+    bytes of `ds` written with `options`.
+    """
+    path = os.path.join(out_dir, 'candidate.nc')
+    encoding = dataset_encoding(ds, options)
+    write_s = read_s = step_s = crop_s = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        ds.to_netcdf(path, encoding=encoding, engine='netcdf4', unlimited_dims=['time'] if 'time' in ds.dims else None)
+        write_s = min(write_s, time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        with xr.open_dataset(path) as ds_read:
+            ds_read.load()
+        read_s = min(read_s, time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        with xr.open_dataset(path) as ds_read:
+            step = ds_read.isel(time=ds_read.sizes['time'] // 2) if 'time' in ds_read.dims else ds_read
+            step.load()
+        step_s = min(step_s, time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        with xr.open_dataset(path) as ds_read:
+            ds_read.isel(crop_window(ds_read, crop_pixels)).load()
+        crop_s = min(crop_s, time.perf_counter() - t0)
+    size = os.path.getsize(path)
+    os.remove(path)
+    return write_s, read_s, step_s, crop_s, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark compression settings on a merged NetCDF day file.")
+    parser.add_argument('sample', help="Merged day file to re-encode")
+    parser.add_argument('--candidates', nargs='+', default=DEFAULT_CANDIDATES,
+                        help="codec[:complevel[:shuffle|noshuffle[:chunks]]] specs")
+    parser.add_argument('--variables', default=None, help="Comma-separated data variables (default: all)")
+    parser.add_argument('--repeat', type=int, default=1, help="Repetitions per candidate (best is reported)")
+    parser.add_argument('--crop-pixels', type=int, default=800,
+                        help="Side of the one-step crop read window in pixels (4 deg at 500 m ~ 800)")
+    parser.add_argument('--tmp-dir', default=None, help="Where candidate files are written (default: system temp)")
+    parser.add_argument('--csv', default=None, help="Also write the results to this CSV file")
+    args = parser.parse_args()
+
+    with xr.open_dataset(args.sample) as ds_sample:
+        if args.variables:
+            ds_sample = ds_sample[[v.strip() for v in args.variables.split(',')]]
+        ds = ds_sample.load()
+    raw_bytes = sum(ds[var].nbytes for var in ds.data_vars)
+
+    print(f"Sample:    {args.sample}")
+    print(f"Variables: {', '.join(ds.data_vars)} {dict(ds.sizes)}")
+    print(f"Raw size:  {raw_bytes / 1024**2:.1f} MB")
+    print()
+    header = f"{'candidate':<40} {'write s':>8} {'read s':>8} {'step s':>8} {'crop s':>8} {'size MB':>9} {'ratio':>6}"
+    print(header)
+    print('-' * len(header))
+
+    rows = []
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as out_dir:
+        for spec in args.candidates:
+            options = parse_candidate(spec)
+            if not codec_available(options['codec']):
+                print(f"{spec:<40} skipped: netCDF4 built without {options['codec']} support")
+                continue
+            try:
+                write_s, read_s, step_s, crop_s, size = benchmark_candidate(
+                    ds, options, out_dir, args.repeat, args.crop_pixels,
+                )
+            except Exception as e:
+                print(f"{spec:<40} failed: {e}")
+                continue
+            ratio = raw_bytes / size
+            print(
+                f"{spec:<40} {write_s:8.2f} {read_s:8.2f} {step_s:8.3f} {crop_s:8.3f} "
+                f"{size / 1024**2:9.1f} {ratio:6.2f}"
+            )
+            rows.append({
+                'candidate': spec, 'encoding': describe(options), 'write_s': round(write_s, 4),
+                'read_s': round(read_s, 4), 'step_read_s': round(step_s, 4),
+                'crop_read_s': round(crop_s, 4), 'size_bytes': size,
+                'ratio': round(ratio, 3),
+            })
+
+    if args.csv and rows:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+        print(f"\nResults written to {args.csv}")
+
+
+if __name__ == "__main__":
+    main()
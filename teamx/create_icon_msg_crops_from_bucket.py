@@ -1,5 +1,6 @@
 import os
 import io
+import argparse
 import boto3
 import logging
 from botocore.exceptions import ClientError
@@ -7,13 +8,26 @@ from botocore.config import Config
 import xarray as xr
 import numpy as np
 import sys
+from dataclasses import dataclass, field, fields, replace
+from datetime import date, datetime, timedelta
+from typing import Optional
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from scipy.ndimage import binary_closing
 
 sys.path.append('/home/Daniele/codes/ICON-GLORI/teamx/')
 from credentials_buckets import S3_BUCKET_ICON, S3_BUCKET_MSG, S3_ACCESS_KEY, S3_SECRET_ACCESS_KEY, S3_ENDPOINT_URL
 
-sys.path.append('/home/Daniele/codes/ML_data_generator/')
-from cropping_functions import filter_by_domain, filter_by_time
+from cropping_functions import domain_slices, filter_by_domain, filter_by_time
+from s3_utils import S3RangeFile, LocalObjectCache
+from stage_timer import StageTimer, print_trace_summary
+from crop_stack import build_crop_stack, write_crop_stack
+from crop_manifest import CropManifest, params_hash
+from crop_utils import (
+    cached_nearest_gather_index, clip_starts, extent_window, gather_crops, is_regular_grid, mask_clear_sky,
+    quantization_encoding, random_tiles, tile_grid, timestep_validity, validity_tables, window_gather_index,
+    window_validity,
+)
 
 
 def plot_sanity_triptych_cartopy(
@@ -140,80 +154,32 @@ def resample_by_extent(
     extent,
     x_pixel,
     y_pixel,
+    index_cache_dir=None,
 ):
     """
     Resample a pre-filtered dataset to target pixel size over the provided extent.
-    """
-    lonmin, lonmax, latmin, latmax = extent
 
+    Nearest-neighbour resampling is done with a gather index that is computed
+    once per (source grid, extent, x_pixel, y_pixel) and cached (see
+    crop_utils.cached_nearest_gather_index), so each call is a single isel.
+    """
     if ds_crop.sizes.get('lon', 0) == 0 or ds_crop.sizes.get('lat', 0) == 0:
         raise ValueError(f"Empty crop for extent: {extent}")
 
-    def _prepare_unique_coord(ds_in, dim_name):
-        """Keep finite coordinates, sort them, and drop duplicates for safe interpolation."""
-        coord = ds_in[dim_name].values
-        finite_idx = np.where(np.isfinite(coord))[0]
-        if finite_idx.size == 0:
-            raise ValueError(f"No finite values found on coordinate '{dim_name}'")
-
-        ds_tmp = ds_in.isel({dim_name: finite_idx})
-        coord = ds_tmp[dim_name].values
-
-        order = np.argsort(coord)
-        ds_tmp = ds_tmp.isel({dim_name: order})
-        coord_sorted = ds_tmp[dim_name].values
-
-        _, unique_idx = np.unique(coord_sorted, return_index=True)
-        if unique_idx.size < coord_sorted.size:
-            ds_tmp = ds_tmp.isel({dim_name: np.sort(unique_idx)})
-
-        return ds_tmp
-
-    # xarray interp requires unique indexes on interpolation coordinates.
-    ds_crop = _prepare_unique_coord(ds_crop, 'lon')
-    ds_crop = _prepare_unique_coord(ds_crop, 'lat')
-
-    # Use overlap between requested extent and actual available coordinate range
-    # to avoid out-of-bounds NaNs during interpolation.
-    lon_vals = ds_crop.lon.values
-    lat_vals = ds_crop.lat.values
-    src_lon_min = float(np.nanmin(lon_vals))
-    src_lon_max = float(np.nanmax(lon_vals))
-    src_lat_min = float(np.nanmin(lat_vals))
-    src_lat_max = float(np.nanmax(lat_vals))
-
-    lon_lo = max(min(lonmin, lonmax), src_lon_min)
-    lon_hi = min(max(lonmin, lonmax), src_lon_max)
-    lat_lo = max(min(latmin, latmax), src_lat_min)
-    lat_hi = min(max(latmin, latmax), src_lat_max)
-
-    if lon_lo >= lon_hi or lat_lo >= lat_hi:
-        raise ValueError(
-            f"No overlap between requested extent {extent} and source bounds "
-            f"lon[{src_lon_min}, {src_lon_max}] lat[{src_lat_min}, {src_lat_max}]"
-        )
-
-    # Coordinates are sorted above, so target grid is built in ascending order.
-    target_lon = np.linspace(lon_lo, lon_hi, x_pixel)
-    target_lat = np.linspace(lat_lo, lat_hi, y_pixel)
-
-    ds_out = ds_crop.interp(
-        lon=target_lon,
-        lat=target_lat,
-        method='nearest',
-        kwargs={'fill_value': 'extrapolate'},
+    lat_idx, lon_idx, target_lat, target_lon = cached_nearest_gather_index(
+        ds_crop.lon.values, ds_crop.lat.values, extent, x_pixel, y_pixel, cache_dir=index_cache_dir,
     )
 
+    ds_out = ds_crop.isel(lat=lat_idx, lon=lon_idx).assign_coords(lat=target_lat, lon=target_lon)
+
     # Fail fast with useful context if output still collapses to NaN.
     if all(xr.DataArray.isnull(ds_out[v]).all() for v in ds_out.data_vars):
         raise ValueError(
             "Resampling produced all-NaN output. "
-            f"Requested extent: {extent}; source bounds: "
-            f"lon[{src_lon_min}, {src_lon_max}] lat[{src_lat_min}, {src_lat_max}]"
+            f"Requested extent: {extent}; target bounds: "
+            f"lon[{target_lon[0]}, {target_lon[-1]}] lat[{target_lat[0]}, {target_lat[-1]}]"
         )
 
-    #print(ds_out)
-
     return ds_out
 
 
@@ -244,18 +210,23 @@ def apply_cloud_mask_threshold(
     return ds_var.fillna(clear_sky_fill_value)
 
 
-
-def read_file(s3, file_name, bucket):
-    """Upload a file to an S3 bucket
+def read_file(s3, file_name, bucket, streaming=False, cache=None, block_size=4 * 1024**2, max_blocks=16):
+    """Read an object from an S3 bucket
     :param s3: Initialized S3 client object
-    :param file_name: File to upload
-    :param bucket: Bucket to upload to
-    :return: object if file was uploaded, else False
+    :param file_name: Key of the object to read
+    :param bucket: Bucket to read from
+    :param streaming: return a lazily range-read S3RangeFile instead of the full bytes
+    :param cache: optional LocalObjectCache; when given, a local file path is returned
+    :param block_size: range-request size of a streaming read
+    :param max_blocks: blocks kept in the LRU cache of a streaming read
+    :return: bytes, S3RangeFile or local path if the object exists, else None
     """
     try:
-        #with open(file_name, "rb") as f:
+        if cache is not None:
+            return cache.get_path(s3, bucket, file_name)
+        if streaming:
+            return S3RangeFile(s3, bucket, file_name, block_size=block_size, max_blocks=max_blocks)
         obj = s3.get_object(Bucket=bucket, Key=file_name)
-        #print(obj)
         myObject = obj['Body'].read()
     except ClientError as e:
         logging.error(e)
@@ -263,74 +234,235 @@ def read_file(s3, file_name, bucket):
     return myObject
 
 
-# Initialize the S3 client
-s3 = boto3.client(
-    's3',
-    endpoint_url=S3_ENDPOINT_URL,
-    aws_access_key_id=S3_ACCESS_KEY,
-    aws_secret_access_key=S3_SECRET_ACCESS_KEY,
-    config=Config(
-        connect_timeout=10,
-        read_timeout=120,
-        retries={'max_attempts': 3, 'mode': 'standard'},
-    ),
-)
-
-# List the objects in our bucket
-debug_list_bucket = False
-if debug_list_bucket:
-    print(f"Bucket contents before upload:")
-    response = s3.list_objects(Bucket=S3_BUCKET_ICON)
-    for item in response['Contents']:
-        print(item['Key'])
-
-
-# Directory and source settings
-years = [2025]
-months = range(4, 5)
-days = range(1, 32)
-
-icon_basename = "merged_SYNMSG_BT_CL_IR10.8_CLCT"
-icon_initialization_hour = '00'
-
-msg_path_dir = "/data/sat/msg/ml_train_crops/IR_108-WV_062-CMA_FULL_EXPATS_DOMAIN"
-msg_basename = "merged_MSG_CMSAF"
-
-# Extent-based cropping settings (lonmin, lonmax, latmin, latmax)
-crop_extent = (11.0, 15.0, 45.0, 49.0) #(7.0, 11.0, 45.0, 49.0) #(11.0, 15.0, 45.0, 49.0) #(9.0, 13.0, 45.0, 49.0)
-domain_name =  'east' #'west' #'east' #'central'
-x_pixel = 100
-y_pixel = 100
-
-# Hour range [hour_start, hour_end)
-hour_start = '01'
-hour_end = '24'
-
-# Value range checks
-value_min = [180.0]
-value_max = [320.0]
-
-# Cloud mask settings
-
-
-cloud_prm_icon = ['SYNMSG_BT_CL_IR10.8']
-cloud_prm_msg = ['IR_108']
+def open_day_object(obj):
+    """Open a day file read by read_file (bytes, local path or S3RangeFile) as an xarray dataset."""
+    if isinstance(obj, (bytes, bytearray)):
+        return xr.open_dataset(io.BytesIO(obj))
+    if isinstance(obj, str):
+        return xr.open_dataset(obj)
+    # Lazy h5netcdf backend: only the variables/hyperslabs that get loaded are fetched.
+    return xr.open_dataset(obj, engine='h5netcdf')
+
+
+def init_s3():
+    """Create an S3 client (one per process: boto3 clients must not be shared across forks)."""
+    return boto3.client(
+        's3',
+        endpoint_url=S3_ENDPOINT_URL,
+        aws_access_key_id=S3_ACCESS_KEY,
+        aws_secret_access_key=S3_SECRET_ACCESS_KEY,
+        config=Config(
+            connect_timeout=10,
+            read_timeout=120,
+            retries={'max_attempts': 3, 'mode': 'standard'},
+        ),
+    )
 
-apply_cma = True
-cma_icon = 'CLCT'
-cma_msg = 'cma'
-cloud_threshold_icon = 50.0
-cloud_threshold_msg = 0
-clear_sky_fill_value = 320.0
 
-file_extension = 'nc'
-save_sanity_plot = False
-verbose = False
+@dataclass
+class CropConfig:
+    """
+    Settings of one crop job.
 
+    Every field can be set from a YAML file (CropConfig.from_yaml); fields
+    that are not given keep the defaults below.
+    """
 
-def vprint(*args, **kwargs):
-    if verbose:
-        print(*args, **kwargs)
+    # Directory and source settings
+    icon_basename: str = "merged_SYNMSG_BT_CL_IR10.8_CLCT"
+    # ICON init cycles processed together, e.g. ['00', '12']. Each valid hour is
+    # cropped from the init with the shortest lead time (lead >= 1 h) and the crops
+    # carry icon_init / lead_time_hours metadata. The objects of all inits of a
+    # day are fetched concurrently by the prefetcher.
+    icon_initialization_hours: list = field(default_factory=lambda: ['00'])
+
+    msg_path_dir: str = "/data/sat/msg/ml_train_crops/IR_108-WV_062-CMA_FULL_EXPATS_DOMAIN"
+    msg_basename: str = "merged_MSG_CMSAF"
+
+    outpath: str = '/data1/crops/teamx_Apr-Sep_2025_icon_msg/nc/1'
+    sanity_plot_outpath: str = "/data1/crops/teamx_Apr-Sep_2025_icon_msg/sanity_plots"
+
+    # Extent-based cropping settings: named domains (lonmin, lonmax, latmin, latmax).
+    # All domains are cropped from a single download/decode of each day file.
+    # In YAML either a list of [name, [lonmin, lonmax, latmin, latmax]] pairs or a name -> extent mapping.
+    crop_domains: list = field(default_factory=lambda: [
+        ('central', (9.0, 13.0, 45.0, 49.0)),
+        ('west', (7.0, 11.0, 45.0, 49.0)),
+        ('east', (11.0, 15.0, 45.0, 49.0)),
+    ])
+    x_pixel: int = 100
+    y_pixel: int = 100
+
+    # Tiling: 'domains' crops the named crop_domains. 'grid' lays tiles of
+    # tile_size (dlon, dlat degrees) every tile_step degrees over tile_extent
+    # (named r<row>c<col>); 'random' draws n_random_tiles tiles inside
+    # tile_extent (named rand<k>), seeded per day from tile_seed. Tiles are index
+    # windows into the single decoded day cube, so extra tiles only add their
+    # gathers. tile_extent None = union of crop_domains.
+    tiling: str = 'domains'
+    tile_extent: Optional[tuple] = None
+    tile_size: tuple = (4.0, 4.0)
+    tile_step: tuple = (2.0, 2.0)
+    n_random_tiles: int = 50
+    tile_seed: int = 0
+
+    # Nearest-neighbour gather indices are cached per source grid/extent/size;
+    # the on-disk copy lets reruns and pool workers skip recomputing them (None = memory only).
+    gather_index_cache_dir: Optional[str] = "/data1/crops/teamx_Apr-Sep_2025_icon_msg/gather_index_cache"
+
+    # Hour range [hour_start, hour_end)
+    hour_start: str = '01'
+    hour_end: str = '24'
+
+    # Value range checks, one entry per channel of cloud_prm_icon/cloud_prm_msg
+    # (same order) or a single entry for all channels. value_min_icon/value_max_icon
+    # and value_min_msg/value_max_msg override them per source, e.g. when ICON
+    # crops more channels than the MSG product holds. None = value_min/value_max.
+    value_min: list = field(default_factory=lambda: [180.0])
+    value_max: list = field(default_factory=lambda: [320.0])
+    value_min_icon: Optional[list] = None
+    value_max_icon: Optional[list] = None
+    value_min_msg: Optional[list] = None
+    value_max_msg: Optional[list] = None
+
+    # Cloud mask settings. With more than one channel in cloud_prm_* the channels
+    # are read in the same decode and each crop holds one channel_var variable
+    # with dims (channel, lat, lon); the channel coordinate names the source variables.
+    cloud_prm_icon: list = field(default_factory=lambda: ['SYNMSG_BT_CL_IR10.8'])
+    cloud_prm_msg: list = field(default_factory=lambda: ['IR_108'])
+    channel_var: str = 'BT'
+
+    apply_cma: bool = True
+    cma_icon: str = 'CLCT'
+    cma_msg: str = 'cma'
+    cloud_threshold_icon: float = 50.0
+    cloud_threshold_msg: float = 0
+    clear_sky_fill_value: float = 320.0
+
+    # Temporal resolution of the MSG crops: 'hourly' keeps the whole-hour slots,
+    # '15min' crops every 15-minute slot (files are then named ..._HHMM_<domain>).
+    # In '15min' mode the hourly ICON cube is brought onto the same slots with
+    # icon_time_alignment: 'nearest' (closest ICON hour) or 'interpolate'
+    # (linear in time between hours, BT and cloud cover alike).
+    msg_time_resolution: str = 'hourly'
+    icon_time_alignment: str = 'nearest'
+
+    # Temporal clips: with clip_length = T every crop is a (time, lat, lon) sequence
+    # of T consecutive valid timesteps (hours, or 15-minute slots) starting every
+    # clip_stride timesteps, cut from the in-memory day cube. Files get a _clip<T>
+    # suffix and hold one chunk per variable. None = single frames.
+    clip_length: Optional[int] = None
+    clip_stride: int = 1
+
+    # Threshold sweep (ICON): a list of CLCT thresholds used instead of
+    # cloud_threshold_icon. Download, decode and resampling run once per day and
+    # one crop set per threshold is written to outpath/<cma_icon>_th<threshold>/.
+    # No sanity plots in sweep mode. None = single threshold.
+    cloud_threshold_sweep_icon: Optional[list] = None
+
+    file_extension: str = 'nc'
+
+    # Output layout: 'files' writes one NetCDF per (timestamp, domain) crop;
+    # 'stack' appends all crops of a source to one (sample, lat, lon) dataset per
+    # stack_period ('day' or 'month') with timestamp/source/domain/init index coords.
+    output_mode: str = 'files'
+    stack_period: str = 'day'
+
+    # Crop storage: 'float' keeps the source dtype; 'int16' (0.01 K steps) or
+    # 'uint8' (0.551 K steps over 180-320 K) pack each variable with
+    # scale_factor/add_offset over its [value_min, value_max] range, widened to
+    # clear_sky_fill_value with apply_cma (uint8 step = (max - min) / 254).
+    crop_encoding: str = 'float'
+
+    save_sanity_plot: bool = False
+    verbose: bool = False
+
+    # Parallel day scheduling: days are independent, so N worker processes
+    # (each with its own S3 client) can process them concurrently. 1 = serial.
+    n_workers: int = 1
+    days_per_task: int = 8
+
+    # Vectorized whole-day masking/resampling (no sanity-plot panels; the
+    # per-timestamp path is used automatically when save_sanity_plot is on).
+    vectorized_crops: bool = True
+
+    # Streaming reads (opt-in): open day files through HTTP range requests with a
+    # block cache instead of downloading whole objects, so memory follows the crop
+    # extent rather than the file size. With streaming, prefetch only opens the
+    # objects and the blocks are fetched while cropping, so downloads no longer
+    # overlap compute; worth it only when the crop extents cover a small part of the grid.
+    stream_icon: bool = False
+    stream_msg: bool = False
+    s3_block_size: int = 4 * 1024**2
+    s3_cache_blocks: int = 16
+
+    # Local object cache (opt-in): day files are kept on disk keyed by
+    # bucket/key/ETag, so reruns after a parameter change skip the downloads.
+    # Takes precedence over streaming reads. None = disabled.
+    local_cache_dir: Optional[str] = None
+    local_cache_max_gb: float = 200
+
+    # Completion manifest (SQLite): every (day, source, domain, init) unit that
+    # finished is recorded with its parameters, so a restarted run skips it without
+    # touching S3. None = disabled.
+    manifest_path: Optional[str] = "/data1/crops/teamx_Apr-Sep_2025_icon_msg/crop_manifest.sqlite"
+
+    # Instrumentation: per-day wall time, bytes and item counts for each stage
+    # (fetch, decode, closing, mask, resample, write) are appended to a JSON-lines
+    # trace in trace_dir, followed by a p50/p95 summary table at the end of the run.
+    instrument: bool = False
+    trace_dir: str = "./logs"
+
+    # Prefetch: keep the ICON/MSG objects of the next K days downloading on I/O
+    # threads while the current day is cropped. 0 = blocking reads.
+    prefetch_days: int = 2
+
+    def __post_init__(self):
+        if isinstance(self.crop_domains, dict):
+            self.crop_domains = list(self.crop_domains.items())
+        self.crop_domains = [(name, tuple(float(e) for e in extent)) for name, extent in self.crop_domains]
+        if self.tiling not in ('domains', 'grid', 'random'):
+            raise ValueError(f"Unknown tiling: {self.tiling}")
+        if self.tile_extent is not None:
+            self.tile_extent = tuple(float(e) for e in self.tile_extent)
+        self.tile_size = tuple(float(e) for e in self.tile_size)
+        self.tile_step = tuple(float(e) for e in self.tile_step)
+        # YAML turns unquoted 00/01 into integers.
+        self.icon_initialization_hours = [f"{int(h):02d}" for h in self.icon_initialization_hours]
+        self.hour_start = f"{int(self.hour_start):02d}"
+        self.hour_end = f"{int(self.hour_end):02d}"
+        for source, cloud_prm in (('icon', self.cloud_prm_icon), ('msg', self.cloud_prm_msg)):
+            for name in ('value_min', 'value_max'):
+                values = self.value_range(name, source)
+                if len(values) not in (1, len(cloud_prm)):
+                    if getattr(self, f"{name}_{source}") is not None:
+                        name = f"{name}_{source}"
+                    raise ValueError(f"{name} needs 1 or {len(cloud_prm)} entries for channels {cloud_prm}")
+        if self.msg_time_resolution not in ('hourly', '15min'):
+            raise ValueError(f"Unknown msg_time_resolution: {self.msg_time_resolution}")
+        if self.icon_time_alignment not in ('nearest', 'interpolate'):
+            raise ValueError(f"Unknown icon_time_alignment: {self.icon_time_alignment}")
+        if self.clip_length is not None and (self.clip_length < 1 or self.clip_stride < 1):
+            raise ValueError("clip_length and clip_stride must be >= 1")
+        if self.cloud_threshold_sweep_icon is not None and not self.apply_cma:
+            raise ValueError("cloud_threshold_sweep_icon needs apply_cma = True")
+
+    def value_range(self, name, source):
+        """The value_min/value_max list (`name`) that applies to `source` ('icon' or 'msg')."""
+        values = getattr(self, f"{name}_{source}")
+        return getattr(self, name) if values is None else values
+
+    @classmethod
+    def from_yaml(cls, path):
+        """Build a config from a YAML mapping of field names to values."""
+        import yaml
+
+        with open(path, encoding='utf-8') as f:
+            settings = yaml.safe_load(f) or {}
+        unknown = set(settings) - {f.name for f in fields(cls)}
+        if unknown:
+            raise ValueError(f"Unknown settings in {path}: {sorted(unknown)}")
+        return cls(**settings)
 
 
 def sanitize_timestamp(ts):
@@ -352,232 +484,1099 @@ def select_timestamps(timestamps, file_date, hour_start, hour_end, include_next_
     return selected
 
 
-def process_day_dataset(ds_day, source_tag, cloud_prm, cma_var, cma_th, file_date, init_label):
-    panels_by_hour = {}
-    ds_day_var = None
-    ds_day_mask = None
-    ds_time_var = None
-    ds_time_mask = None
-    ds_extent_crop = None
+def union_extent(extents):
+    """Return the smallest (lonmin, lonmax, latmin, latmax) extent covering all given extents."""
+    extents = list(extents)
+    return (
+        min(min(e[0], e[1]) for e in extents),
+        max(max(e[0], e[1]) for e in extents),
+        min(min(e[2], e[3]) for e in extents),
+        max(max(e[2], e[3]) for e in extents),
+    )
 
-    try:
-        ds_day_var = ds_day[cloud_prm]
-        ds_day_mask = ds_day[[cma_var]]
 
-        ds_day_var = filter_by_domain(ds_day_var, crop_extent)
-        ds_day_mask = filter_by_domain(ds_day_mask, crop_extent)
+def channel_tag(cloud_prm):
+    """Filename tag of the cropped channels, e.g. 'IR10.8' or 'IR10.8-WV6.2'."""
+    return '-'.join(prm.split('_')[-1] for prm in cloud_prm)
+
+
+def days_in_range(date_range):
+    """
+    Return the (year, month, day) tuples of an inclusive (start, end) range.
+    Start and end are dates or 'YYYY-MM-DD' strings.
+    """
+    start, end = (d if isinstance(d, date) else date.fromisoformat(str(d)) for d in date_range)
+    if end < start:
+        raise ValueError(f"Empty date range: {start} > {end}")
+    return [
+        (d.year, d.month, d.day)
+        for d in (start + timedelta(days=n) for n in range((end - start).days + 1))
+    ]
+
+
+def _failed_day_summary(year, month, day, error):
+    day_str = f"{year:04d}-{month:02d}-{day:02d}"
+    logging.error(f"Day {day_str} failed: {error}")
+    return {'day': day_str, 'icon_saved': 0, 'msg_saved': 0, 'missing': [], 'skipped_units': 0, 'error': str(error)}
+
+
+def print_run_summary(summaries):
+    """Print an end-of-run table from the per-day summaries."""
+    summaries = sorted(summaries, key=lambda s: s['day'])
+    failed = [s for s in summaries if s.get('error')]
+    print()
+    print("=" * 60)
+    print("Summary")
+    print("=" * 60)
+    print(f"Days processed: {len(summaries) - len(failed)}")
+    print(f"Days failed:    {len(failed)}")
+    print(f"ICON crops:     {sum(s['icon_saved'] for s in summaries)}")
+    print(f"MSG crops:      {sum(s['msg_saved'] for s in summaries)}")
+    print(f"Missing files:  {sum(len(s['missing']) for s in summaries)}")
+    print(f"Units skipped:  {sum(s['skipped_units'] for s in summaries)} (already complete)")
+    for s in failed:
+        print(f"  FAILED {s['day']}: {s['error']}")
+
+
+class CropJob:
+    """
+    ICON/MSG crop generator for one CropConfig.
+
+    Nothing happens until `run(date_range)` is called, so jobs can be built
+    from a scheduler or several configurations can run in one process. Jobs
+    in the same process share the in-memory gather-index cache; an S3 client
+    can be shared by passing it in (one is created on first use otherwise).
+    """
+
+    def __init__(self, config=None, s3=None, trace_path=None):
+        self.config = config if config is not None else CropConfig()
+        self._s3 = s3
+        self.timer = StageTimer(trace_path)
+        cfg = self.config
+        self.object_cache = (
+            LocalObjectCache(cfg.local_cache_dir, cfg.local_cache_max_gb * 1024**3) if cfg.local_cache_dir else None
+        )
 
-        timestamps = ds_day_var.time.values
+    @property
+    def s3(self):
+        if self._s3 is None:
+            self._s3 = init_s3()
+        return self._s3
+
+    def vprint(self, *args, **kwargs):
+        if self.config.verbose:
+            print(*args, **kwargs)
+
+    def fetch_day_object(self, file_name, bucket, streaming, day_str, source_tag):
+        """read_file with the 'fetch' stage timed (streamed bytes are counted when the file is closed)."""
+        cfg = self.config
+        with self.timer.stage('fetch', day_str, source_tag) as st:
+            obj = read_file(
+                self.s3, file_name, bucket, streaming=streaming, cache=self.object_cache,
+                block_size=cfg.s3_block_size, max_blocks=cfg.s3_cache_blocks,
+            )
+            if isinstance(obj, (bytes, bytearray)):
+                st['bytes'] = len(obj)
+            elif isinstance(obj, str):
+                st['bytes'] = os.path.getsize(obj)
+            st['items'] = int(obj is not None)
+        return obj
+
+    def close_day_object(self, obj, day_str, source_tag):
+        """Close a streaming day object and account for the bytes it fetched."""
+        if isinstance(obj, S3RangeFile):
+            self.timer.add('s3_stream', day_str, source_tag, n_bytes=obj.bytes_fetched, items=obj.n_requests)
+            obj.close()
+
+    def crop_timestamps(self, timestamps, source_tag, file_date):
+        """Return the timestamps of a day file that get cropped."""
         # ICON keeps previous behavior (include next-day 00), MSG stays on day/hour range.
         timestamps = select_timestamps(
             timestamps=timestamps,
             file_date=file_date,
-            hour_start=hour_start,
-            hour_end=hour_end,
+            hour_start=self.config.hour_start,
+            hour_end=self.config.hour_end,
             include_next_day_midnight=(source_tag == 'ICON'),
         )
 
-        for timestamp in timestamps:
-            vprint(f"[{source_tag}] Processing timestamp: {timestamp}")
-            t_str = str(timestamp)
-            t_date = t_str.split('T')[0]
-            t_hour = t_str.split('T')[1][0:2]
-            # MSG: only process whole-hour timestamps
-            if source_tag == 'MSG' and t_str.split('T')[1][3:5] != '00':
-                continue
-            ds_extent_crop = None
-            ds_time_var = None
-            ds_time_mask = None
+        # MSG: only process whole-hour timestamps unless all 15-minute slots are requested
+        if source_tag == 'MSG' and self.config.msg_time_resolution == 'hourly':
+            timestamps = [t for t in timestamps if str(t).split('T')[1][3:5] == '00']
+        return timestamps
+
+    def close_cloud_mask(self, ds_day, cma_var, file_date, domains, structure):
+        """
+        Apply binary_closing to the cloud mask on the cropped timestamps and domain only.
+
+        The closing runs on the selected timestamps over the union of the domain
+        extents plus a halo of twice the structure radius (dilation + erosion), so
+        every pixel inside the extent is identical to closing the full-domain array.
+        Returns the dataset reduced to that time/space window with the closed mask.
+        """
+        timestamps = self.crop_timestamps(ds_day.time.values, 'MSG', file_date)
+        halo = 2 * (max(structure.shape[1:]) // 2)
+        window = extent_window(
+            ds_day.lon.values, ds_day.lat.values, union_extent(extent for _, extent in domains), halo,
+        )
+        if not timestamps or window is None:
+            # Nothing to crop: keep an empty selection so downstream filters yield no crops.
+            return ds_day.isel(time=slice(0, 0))
+
+        lat_slice, lon_slice = window
+        ds_day = ds_day.sel(time=timestamps).isel(lat=lat_slice, lon=lon_slice)
+        with self.timer.stage('decode', file_date, 'MSG') as st:
+            cma_values = ds_day[cma_var].transpose('time', 'lat', 'lon').values
+            st['items'], st['bytes'] = len(timestamps), cma_values.nbytes
+        with self.timer.stage('closing', file_date, 'MSG') as st:
+            ds_day[cma_var] = (('time', 'lat', 'lon'), binary_closing(cma_values, structure=structure))
+            st['items'], st['bytes'] = len(timestamps), cma_values.nbytes
+        return ds_day
+
+    def load_day_cube(self, ds_day, source_tag, cloud_prm, cma_var, file_date, init_label, domains):
+        """
+        Select the timestamps to crop and load them over the union of the domain extents.
+
+        Returns (ds_day_var, ds_day_mask, timestamps); the datasets are None when
+        no timestamp is selected.
+        """
+        ds_day_var = ds_day[cloud_prm]
+        ds_day_mask = ds_day[[cma_var]]
+
+        day_extent = union_extent(extent for _, extent in domains)
+        ds_day_var = filter_by_domain(ds_day_var, day_extent)
+        ds_day_mask = filter_by_domain(ds_day_mask, day_extent)
 
-            try:
-                ds_time_var = filter_by_time(ds_day_var, timestamp)
-                ds_time_mask = filter_by_time(ds_day_mask, timestamp)
+        timestamps = self.crop_timestamps(ds_day_var.time.values, source_tag, file_date)
+        if not timestamps:
+            return None, None, timestamps
 
-                is_all_nan_ds = all(xr.DataArray.isnull(ds_time_var[var]).all() for var in ds_time_var.data_vars)
-                is_outside_range = any(
-                    ((ds_time_var[var] < value_min[i]) | (ds_time_var[var] > value_max[i])).any()
-                    for i, var in enumerate(ds_time_var.data_vars)
+        # Single decode of the selected hours over the union extent; all domains reuse it.
+        with self.timer.stage('decode', file_date, source_tag) as st:
+            ds_day_var = ds_day_var.sel(time=timestamps).load()
+            ds_day_mask = ds_day_mask.sel(time=timestamps).load()
+            st['items'], st['bytes'] = len(timestamps), ds_day_var.nbytes + ds_day_mask.nbytes
+
+        if source_tag == 'ICON' and self.config.msg_time_resolution == '15min':
+            with self.timer.stage('align', file_date, source_tag) as st:
+                ds_day_var, ds_day_mask, timestamps = self.align_to_msg_slots(
+                    ds_day_var, ds_day_mask, timestamps, file_date, init_label,
                 )
+                st['items'] = len(timestamps)
+        return ds_day_var, ds_day_mask, timestamps
+
+    def align_to_msg_slots(self, ds_day_var, ds_day_mask, timestamps, file_date, init):
+        """
+        Bring the loaded hourly ICON cube onto the 15-minute slots between its first
+        and last selected hour that are paired with `init` (shortest_lead_init), by
+        nearest hour or linear interpolation in time (icon_time_alignment).
+        Returns (ds_day_var, ds_day_mask, slot timestamps).
+        """
+        slots = np.arange(timestamps[0], timestamps[-1] + np.timedelta64(1, 'm'), np.timedelta64(15, 'm'))
+        slots = np.array([t for t in slots if self.shortest_lead_init(t, file_date) == init], dtype=slots.dtype)
+        aligned = []
+        for ds in (ds_day_var, ds_day_mask):
+            if self.config.icon_time_alignment == 'nearest':
+                ds_slots = ds.sel(time=slots, method='nearest').assign_coords(time=slots)
+            else:
+                ds_slots = ds.interp(time=slots)
+                for var in ds.data_vars:
+                    ds_slots[var] = ds_slots[var].astype(ds[var].dtype)
+            aligned.append(ds_slots)
+        return aligned[0], aligned[1], list(slots)
+
+    def time_label(self, timestamp):
+        """'HH' of a crop timestamp, or 'HHMM' when cropping 15-minute slots."""
+        t_time = str(timestamp).split('T')[1]
+        if self.config.msg_time_resolution == 'hourly':
+            return t_time[0:2]
+        return t_time[0:2] + t_time[3:5]
+
+    def time_step(self):
+        """Spacing of consecutive crop timestamps."""
+        return np.timedelta64(60 if self.config.msg_time_resolution == 'hourly' else 15, 'm')
+
+    def msg_init_label(self):
+        """Init label of the MSG crops (manifest unit and stack index): the MSG time resolution."""
+        return self.config.msg_time_resolution
+
+    def crop_outdir(self, cma_var, sweep_threshold=None):
+        """Output directory of the crops; each threshold of a sweep gets its own subdirectory."""
+        if sweep_threshold is None:
+            return self.config.outpath
+        return f"{self.config.outpath}/{cma_var}_th{sweep_threshold:g}"
+
+    def crop_filepath(self, source_tag, cloud_prm, cma_var, file_date, init_label, timestamp, domain_name, sweep_threshold=None):
+        cfg = self.config
+        outdir = self.crop_outdir(cma_var, sweep_threshold)
+        t_date = str(timestamp).split('T')[0]
+        t_label = self.time_label(timestamp)
+        clip = '' if cfg.clip_length is None else f"_clip{cfg.clip_length}"
+        if source_tag == 'ICON':
+            return (
+                f"{outdir}/ICON500m_{channel_tag(cloud_prm)}_{cma_var}_"
+                f"{file_date.replace('-', '')}_{init_label}_{t_date}_{t_label}_{domain_name}{clip}.{cfg.file_extension}"
+            )
+        return (
+            f"{outdir}/MSG_{channel_tag(cloud_prm)}_{cma_var}_"
+            f"{t_date}_{t_label}_{domain_name}{clip}.{cfg.file_extension}"
+        )
+
+    def stack_filepath(self, source_tag, cloud_prm, cma_var, file_date, init_label, sweep_threshold=None):
+        cfg = self.config
+        outdir = self.crop_outdir(cma_var, sweep_threshold)
+        period = file_date.replace('-', '') if cfg.stack_period == 'day' else file_date[:7].replace('-', '')
+        clip = '' if cfg.clip_length is None else f"_clip{cfg.clip_length}"
+        if source_tag == 'ICON':
+            return f"{outdir}/ICON500m_{channel_tag(cloud_prm)}_{cma_var}_init{init_label}{clip}_stack_{period}.nc"
+        resolution = '' if cfg.msg_time_resolution == 'hourly' else f"_{cfg.msg_time_resolution}"
+        return f"{outdir}/MSG_{channel_tag(cloud_prm)}_{cma_var}{resolution}{clip}_stack_{period}.nc"
+
+    def emit_crop(
+        self, ds_extent_crop, stack_crops, source_tag, cloud_prm, cma_var, file_date, init_label, timestamp, domain_name,
+        sweep_threshold=None,
+    ):
+        """
+        Write one crop file, or queue the crop in `stack_crops` when output_mode is 'stack'.
+        Multi-channel crops are merged into one (channel, lat, lon) variable first.
+        ICON crops carry their init and lead time (of the first frame for clips).
+        Returns the identifier recorded in the manifest (file path, or stack path::timestamp).
+        """
+        ds_extent_crop = self.stack_channels(ds_extent_crop)
+        lead_time_hours = None
+        if source_tag == 'ICON':
+            lead_time_hours = self.icon_lead_hours(timestamp, file_date, init_label)
+        if self.config.output_mode == 'stack':
+            meta = {
+                'timestamp': timestamp, 'source': source_tag, 'domain': domain_name, 'init': init_label,
+                'day': file_date,
+            }
+            if lead_time_hours is not None:
+                meta['lead_time_hours'] = lead_time_hours
+            stack_crops.append((ds_extent_crop, meta))
+            stack_path = self.stack_filepath(source_tag, cloud_prm, cma_var, file_date, init_label, sweep_threshold)
+            return f"{stack_path}::{sanitize_timestamp(timestamp)}_{domain_name}"
+
+        if lead_time_hours is not None:
+            ds_extent_crop = ds_extent_crop.assign_attrs(icon_init=init_label, lead_time_hours=lead_time_hours)
+        filepath = self.crop_filepath(
+            source_tag, cloud_prm, cma_var, file_date, init_label, timestamp, domain_name, sweep_threshold,
+        )
+        self.save_crop(ds_extent_crop, filepath, file_date, source_tag)
+        print(f"[{source_tag}] saved: {filepath}")
+        return filepath
+
+    def write_day_stack(self, stack_crops, source_tag, cloud_prm, cma_var, file_date, init_label, sweep_threshold=None):
+        """Write the crops queued by emit_crop for one day and source into its stack file."""
+        if not stack_crops:
+            return
+        stack_path = self.stack_filepath(source_tag, cloud_prm, cma_var, file_date, init_label, sweep_threshold)
+        with self.timer.stage('write', file_date, source_tag) as st:
+            ds_stack = build_crop_stack(stack_crops)
+            n_written = write_crop_stack(
+                ds_stack, stack_path, append=(self.config.stack_period != 'day'),
+                var_encoding=self.crop_var_encoding(ds_stack, source_tag),
+            )
+            st['items'], st['bytes'] = n_written, os.path.getsize(stack_path)
+        if n_written != ds_stack.sizes['sample']:
+            # Raising keeps the day's units out of the manifest, so they are re-cropped.
+            raise RuntimeError(
+                f"Only {n_written} of {ds_stack.sizes['sample']} crops were written to {stack_path}"
+            )
+        print(f"[{source_tag}] stacked {n_written} crops: {stack_path}")
+
+    def save_crop(self, ds_extent_crop, filepath, file_date, source_tag):
+        with self.timer.stage('write', file_date, source_tag) as st:
+            self._write_crop(ds_extent_crop, filepath, source_tag)
+            st['items'], st['bytes'] = 1, os.path.getsize(filepath)
+
+    def channel_ranges(self, source_tag):
+        """
+        Per-channel (value_min, value_max) lists of a source's cloud_prm channels;
+        a single configured value applies to every channel.
+        """
+        cfg = self.config
+        source = source_tag.lower()
+        n_channels = len(cfg.cloud_prm_icon if source == 'icon' else cfg.cloud_prm_msg)
+        value_min, value_max = cfg.value_range('value_min', source), cfg.value_range('value_max', source)
+        value_min = value_min * n_channels if len(value_min) == 1 else value_min
+        value_max = value_max * n_channels if len(value_max) == 1 else value_max
+        return value_min, value_max
+
+    def stack_channels(self, ds_crop):
+        """Merge the channel variables of a multi-channel crop into one (channel, lat, lon) variable."""
+        var_names = list(ds_crop.data_vars)
+        if len(var_names) == 1:
+            return ds_crop
+        da = ds_crop.to_array(dim='channel', name=self.config.channel_var)
+        da.attrs = ds_crop[var_names[0]].attrs
+        da = da.transpose(*[d for d in ('time', 'channel', 'lat', 'lon') if d in da.dims])
+        return xr.Dataset({da.name: da}, attrs=ds_crop.attrs)
+
+    def packing_range(self, value_min, value_max):
+        """
+        Range a channel is packed over: [value_min, value_max] widened to
+        clear_sky_fill_value when the cloud mask is applied, since masked crops hold
+        that value as well (e.g. 320 K fill with a 280 K WV6.2 value_max).
+        """
+        if not self.config.apply_cma:
+            return value_min, value_max
+        fill_value = self.config.clear_sky_fill_value
+        return min(value_min, fill_value), max(value_max, fill_value)
+
+    def crop_var_encoding(self, ds_crop, source_tag):
+        """
+        Per-variable packing from crop_encoding; variables follow the cloud_prm order of
+        value_min/value_max, a (channel, lat, lon) variable is packed over the union of its
+        channel ranges. Ranges include the clear-sky fill value (packing_range).
+        """
+        cfg = self.config
+        if 'channel' in ds_crop.dims:
+            value_min, value_max = self.channel_ranges(source_tag)
+            return {
+                var: quantization_encoding(*self.packing_range(min(value_min), max(value_max)), cfg.crop_encoding)
+                for var in ds_crop.data_vars
+            }
+        value_min, value_max = self.channel_ranges(source_tag)
+        return {
+            var: quantization_encoding(*self.packing_range(value_min[i], value_max[i]), cfg.crop_encoding)
+            for i, var in enumerate(ds_crop.data_vars)
+        }
+
+    def _write_crop(self, ds_extent_crop, filepath, source_tag):
+        var_encoding = self.crop_var_encoding(ds_extent_crop, source_tag)
+        encoding = {
+            var: {
+                'zlib': True,
+                'complevel': 4,
+                'dtype': ds_extent_crop[var].dtype.name,
+                **var_encoding[var],
+            }
+            for var in ds_extent_crop.data_vars
+        }
+        if self.config.clip_length is not None:
+            # A clip is always read whole: one chunk per variable.
+            for var in ds_extent_crop.data_vars:
+                encoding[var]['chunksizes'] = ds_extent_crop[var].shape
+        ds_extent_crop.to_netcdf(filepath, encoding=encoding, engine='h5netcdf')
+
+    def process_day_dataset(self, ds_day, source_tag, cloud_prm, cma_var, cma_th, file_date, init_label, domains=None):
+        """
+        Crop every selected timestamp of a day dataset for all named domains.
+
+        The day is filtered to the union of the domain extents and loaded once;
+        each (timestamp, domain) crop is then cut from the in-memory data.
+        `domains` is a list of (domain_name, extent) pairs (default: crop_domains).
+        Returns (panels_by_hour, saved) with saved = {domain_name: [written file paths]}.
+        """
+        cfg = self.config
+        if domains is None:
+            domains = cfg.crop_domains
+
+        panels_by_hour = {}
+        value_min, value_max = self.channel_ranges(source_tag)
+        saved = {domain_name: [] for domain_name, _ in domains}
+        stack_crops = []
+        ds_day_var = None
+        ds_day_mask = None
+        ds_time_var = None
+        ds_time_mask = None
+        ds_extent_crop = None
+
+        try:
+            ds_day_var, ds_day_mask, timestamps = self.load_day_cube(
+                ds_day, source_tag, cloud_prm, cma_var, file_date, init_label, domains,
+            )
+            if not timestamps:
+                return panels_by_hour, saved
+
+            # Domain windows depend only on the day grid: search them once, reuse for every timestamp.
+            day_lon, day_lat = ds_day_var['lon'].values, ds_day_var['lat'].values
+            slices = {name: domain_slices(day_lon, day_lat, extent) for name, extent in domains}
+
+            for timestamp in timestamps:
+                self.vprint(f"[{source_tag}] Processing timestamp: {timestamp}")
+                t_str = str(timestamp)
+                t_date = t_str.split('T')[0]
+                t_hour = self.time_label(timestamp)
+
+                for domain_name, crop_extent in domains:
+                    ds_extent_crop = None
+                    ds_time_var = None
+                    ds_time_mask = None
+
+                    try:
+                        ds_time_var = filter_by_domain(
+                            filter_by_time(ds_day_var, timestamp), crop_extent, slices[domain_name],
+                        )
+                        ds_time_mask = filter_by_domain(
+                            filter_by_time(ds_day_mask, timestamp), crop_extent, slices[domain_name],
+                        )
 
-                if is_all_nan_ds or is_outside_range:
+                        is_all_nan_ds = all(xr.DataArray.isnull(ds_time_var[var]).all() for var in ds_time_var.data_vars)
+                        is_outside_range = any(
+                            ((ds_time_var[var] < value_min[i]) | (ds_time_var[var] > value_max[i])).any()
+                            for i, var in enumerate(ds_time_var.data_vars)
+                        )
+
+                        if is_all_nan_ds or is_outside_range:
+                            continue
+
+                        da_before_mask = None
+                        if cfg.save_sanity_plot:
+                            da_before_mask = ds_time_var[cloud_prm[0]].copy(deep=True)
+
+                        if cfg.apply_cma:
+                            with self.timer.stage('mask', file_date, source_tag) as st:
+                                ds_time_var = apply_cloud_mask_threshold(
+                                    ds_var=ds_time_var,
+                                    ds_full=ds_time_mask,
+                                    cloud_mask_var=cma_var,
+                                    cloud_threshold=cma_th,
+                                    clear_sky_fill_value=cfg.clear_sky_fill_value,
+                                )
+                                st['items'] = 1
+
+                        with self.timer.stage('resample', file_date, source_tag) as st:
+                            ds_extent_crop = resample_by_extent(
+                                ds_crop=ds_time_var,
+                                extent=crop_extent,
+                                x_pixel=cfg.x_pixel,
+                                y_pixel=cfg.y_pixel,
+                                index_cache_dir=cfg.gather_index_cache_dir,
+                            )
+                            st['items'] = 1
+
+                        if cfg.save_sanity_plot:
+                            panels_by_hour[f"{t_date}_{t_hour}_{domain_name}"] = (
+                                da_before_mask,
+                                ds_time_var[cloud_prm[0]].copy(deep=True),
+                                ds_extent_crop[cloud_prm[0]].copy(deep=True),
+                                cloud_prm[0],
+                            )
+
+                        has_nan = any(xr.DataArray.isnull(ds_extent_crop[var]).any() for var in ds_extent_crop.data_vars)
+                        if has_nan:
+                            print(f"[{source_tag}] NaN values detected at {timestamp} ({domain_name}); skipping")
+                            continue
+
+                        saved[domain_name].append(self.emit_crop(
+                            ds_extent_crop, stack_crops, source_tag, cloud_prm, cma_var,
+                            file_date, init_label, timestamp, domain_name,
+                        ))
+
+                    finally:
+                        if ds_extent_crop is not None:
+                            ds_extent_crop.close()
+                        if ds_time_mask is not None:
+                            ds_time_mask.close()
+                        if ds_time_var is not None:
+                            ds_time_var.close()
+
+            self.write_day_stack(stack_crops, source_tag, cloud_prm, cma_var, file_date, init_label)
+            return panels_by_hour, saved
+
+        finally:
+            if ds_day_mask is not None:
+                ds_day_mask.close()
+            if ds_day_var is not None:
+                ds_day_var.close()
+
+    def process_day_dataset_vectorized(
+        self, ds_day, source_tag, cloud_prm, cma_var, cma_th, file_date, init_label, domains=None, threshold_sweep=None,
+    ):
+        """
+        Whole-day version of process_day_dataset working on (time, lat, lon) NumPy cubes.
+
+        Per domain: one validity check, one nearest-neighbour gather of the
+        variables and the cloud mask, then one cloud-mask op across all selected
+        hours; only the hours that pass are written. Gather and mask both act
+        pixel-wise, so masking the gathered crops equals resampling the masked field.
+        With clip_length set, (time, lat, lon) clips of consecutive valid hours are
+        emitted instead of single frames (saved ids are then per clip start).
+        With `threshold_sweep` (a list of thresholds replacing cma_th) the gathered
+        crops are masked once per threshold and each set goes to its own
+        subdirectory (see crop_outdir).
+        Produces the same crops as process_day_dataset but no sanity-plot panels.
+        Returns ({}, saved) like process_day_dataset.
+        """
+        cfg = self.config
+        if domains is None:
+            domains = cfg.crop_domains
+        thresholds = [None] if threshold_sweep is None else list(threshold_sweep)
+
+        saved = {domain_name: [] for domain_name, _ in domains}
+        stack_crops = {th: [] for th in thresholds}
+        ds_day_var, ds_day_mask, timestamps = self.load_day_cube(
+            ds_day, source_tag, cloud_prm, cma_var, file_date, init_label, domains,
+        )
+        if not timestamps:
+            return {}, saved
+        time_values = np.asarray(timestamps)
+        value_min, value_max = self.channel_ranges(source_tag)
+        var_names = list(ds_day_var.data_vars)
+
+        tiled = cfg.tiling != 'domains'
+        if tiled:
+            # Tiles are index windows (views) into the in-memory day cube: no per-tile xarray selection.
+            day_lon, day_lat = ds_day_var.lon.values, ds_day_var.lat.values
+            day_cubes = [ds_day_var[var].transpose('time', 'lat', 'lon').values for var in var_names]
+            day_mask = ds_day_mask[cma_var].transpose('time', 'lat', 'lon').values
+            regular_grid = is_regular_grid(day_lon) and is_regular_grid(day_lat)
+            # NaN/range checks of every tile from one pass over the day cube (tiles overlap).
+            day_validity = validity_tables(day_cubes, value_min, value_max)
+
+        try:
+            for domain_name, crop_extent in domains:
+                if tiled:
+                    window = extent_window(day_lon, day_lat, crop_extent)
+                    if window is None:
+                        continue
+                    lat_slice, lon_slice = window
+                    dom_lon, dom_lat = day_lon[lon_slice], day_lat[lat_slice]
+                    cubes = [cube[:, lat_slice, lon_slice] for cube in day_cubes]
+                    mask_cube = day_mask[:, lat_slice, lon_slice]
+                else:
+                    ds_dom_var = filter_by_domain(ds_day_var, crop_extent)
+                    ds_dom_mask = filter_by_domain(ds_day_mask, crop_extent)
+                    dom_lon, dom_lat = ds_dom_var.lon.values, ds_dom_var.lat.values
+                    cubes = [ds_dom_var[var].transpose('time', 'lat', 'lon').values for var in var_names]
+                    mask_cube = ds_dom_mask[cma_var].transpose('time', 'lat', 'lon').values
+
+                if tiled:
+                    valid = window_validity(day_validity, window)
+                else:
+                    valid = timestep_validity(cubes, value_min, value_max)
+                if not valid.any():
                     continue
 
-                da_before_mask = None
-                if save_sanity_plot:
-                    da_before_mask = ds_time_var[cloud_prm[0]].copy(deep=True)
-
-                if apply_cma:
-                    ds_time_var = apply_cloud_mask_threshold(
-                        ds_var=ds_time_var,
-                        ds_full=ds_time_mask,
-                        cloud_mask_var=cma_var,
-                        cloud_threshold=cma_th,
-                        clear_sky_fill_value=clear_sky_fill_value,
-                    )
+                with self.timer.stage('resample', file_date, source_tag) as st:
+                    if tiled and regular_grid:
+                        # One index per tile size, shared by all tiles of the day.
+                        lat_idx, lon_idx, target_lat, target_lon = window_gather_index(
+                            dom_lon, dom_lat, cfg.x_pixel, cfg.y_pixel,
+                        )
+                    else:
+                        # Random tiles never repeat, so their indices are not worth a file each.
+                        lat_idx, lon_idx, target_lat, target_lon = cached_nearest_gather_index(
+                            dom_lon, dom_lat, crop_extent, cfg.x_pixel, cfg.y_pixel,
+                            cache_dir=None if cfg.tiling == 'random' else cfg.gather_index_cache_dir,
+                        )
+                    crops = [gather_crops(cube, lat_idx, lon_idx) for cube in cubes]
+                    if cfg.apply_cma:
+                        mask_crop = gather_crops(mask_cube, lat_idx, lon_idx)
+                    st['items'], st['bytes'] = len(timestamps), sum(crop.nbytes for crop in crops)
+
+                for th in thresholds:
+                    th_crops = crops
+                    if cfg.apply_cma:
+                        with self.timer.stage('mask', file_date, source_tag) as st:
+                            th_crops = [
+                                mask_clear_sky(crop, mask_crop, cma_th if th is None else th, cfg.clear_sky_fill_value)
+                                for crop in crops
+                            ]
+                            st['items'], st['bytes'] = len(timestamps), sum(crop.nbytes for crop in th_crops)
+
+                    th_valid = valid.copy()
+                    for crop in th_crops:
+                        has_nan = np.isnan(crop).reshape(crop.shape[0], -1).any(axis=1)
+                        for t_i in np.where(th_valid & has_nan)[0]:
+                            print(f"[{source_tag}] NaN values detected at {timestamps[t_i]} ({domain_name}); skipping")
+                        th_valid &= ~has_nan
+
+                    if cfg.clip_length is None:
+                        samples = [(t_i, t_i, ('lat', 'lon')) for t_i in np.where(th_valid)[0]]
+                    else:
+                        samples = [
+                            (t_i, slice(t_i, t_i + cfg.clip_length), ('time', 'lat', 'lon'))
+                            for t_i in clip_starts(th_valid, timestamps, cfg.clip_length, self.time_step(), cfg.clip_stride)
+                        ]
+
+                    for t_i, t_sel, dims in samples:
+                        timestamp = timestamps[t_i]
+                        ds_extent_crop = xr.Dataset(
+                            {
+                                var: (dims, th_crops[v_i][t_sel], ds_day_var[var].attrs)
+                                for v_i, var in enumerate(var_names)
+                            },
+                            coords={'lat': target_lat, 'lon': target_lon, 'time': time_values[t_sel]},
+                            attrs=ds_day_var.attrs,
+                        )
+                        saved[domain_name].append(self.emit_crop(
+                            ds_extent_crop, stack_crops[th], source_tag, cloud_prm, cma_var,
+                            file_date, init_label, timestamp, domain_name, sweep_threshold=th,
+                        ))
 
-                da_after_mask = ds_time_var[cloud_prm[0]]
-                ds_extent_crop = resample_by_extent(
-                    ds_crop=ds_time_var,
-                    extent=crop_extent,
-                    x_pixel=x_pixel,
-                    y_pixel=y_pixel,
-                )
+            for th in thresholds:
+                self.write_day_stack(stack_crops[th], source_tag, cloud_prm, cma_var, file_date, init_label, th)
+            return {}, saved
+
+        finally:
+            ds_day_mask.close()
+            ds_day_var.close()
 
-                if save_sanity_plot:
-                    panels_by_hour[f"{t_date}_{t_hour}"] = (
-                        da_before_mask,
-                        ds_time_var[cloud_prm[0]].copy(deep=True),
-                        ds_extent_crop[cloud_prm[0]].copy(deep=True),
-                        cloud_prm[0],
+    def crop_day_dataset(self, threshold_sweep=None, **kwargs):
+        """Dispatch to the vectorized or per-timestamp day cropper (threshold sweeps and clips are always vectorized)."""
+        if threshold_sweep is not None or self.config.clip_length is not None:
+            return self.process_day_dataset_vectorized(threshold_sweep=threshold_sweep, **kwargs)
+        if self.config.vectorized_crops and not self.config.save_sanity_plot:
+            return self.process_day_dataset_vectorized(**kwargs)
+        return self.process_day_dataset(**kwargs)
+
+    def unit_params(self, source_tag, extent):
+        """Settings that determine the crops of one (day, source, domain, init) manifest unit."""
+        cfg = self.config
+        if source_tag == 'ICON':
+            cloud_prm, cma_var, cma_th = cfg.cloud_prm_icon, cfg.cma_icon, cfg.cloud_threshold_icon
+        else:
+            cloud_prm, cma_var, cma_th = cfg.cloud_prm_msg, cfg.cma_msg, cfg.cloud_threshold_msg
+        params = {
+            'cloud_prm': cloud_prm,
+            'cma_var': cma_var,
+            'cma_th': cma_th,
+            'apply_cma': cfg.apply_cma,
+            'clear_sky_fill_value': cfg.clear_sky_fill_value,
+            'value_min': cfg.value_range('value_min', source_tag.lower()),
+            'value_max': cfg.value_range('value_max', source_tag.lower()),
+            'extent': list(extent),
+            'x_pixel': cfg.x_pixel,
+            'y_pixel': cfg.y_pixel,
+            'hour_start': cfg.hour_start,
+            'hour_end': cfg.hour_end,
+            'outpath': cfg.outpath,
+            'file_extension': cfg.file_extension,
+            'output_mode': cfg.output_mode,
+            'stack_period': cfg.stack_period,
+            'crop_encoding': cfg.crop_encoding,
+        }
+        if source_tag == 'ICON' and len(cfg.icon_initialization_hours) > 1:
+            # The hours paired with an init depend on the other inits of the run.
+            params['icon_initialization_hours'] = cfg.icon_initialization_hours
+        if cfg.clip_length is not None:
+            params['clip_length'] = cfg.clip_length
+            params['clip_stride'] = cfg.clip_stride
+        if cfg.msg_time_resolution != 'hourly':
+            params['msg_time_resolution'] = cfg.msg_time_resolution
+            if source_tag == 'ICON':
+                params['icon_time_alignment'] = cfg.icon_time_alignment
+        if source_tag == 'ICON' and cfg.cloud_threshold_sweep_icon is not None:
+            params['cma_th_sweep'] = list(cfg.cloud_threshold_sweep_icon)
+        return params
+
+    def day_domains(self, day_str):
+        """(name, extent) pairs cropped on a day: crop_domains, or the grid/random tiles of the tiling setting."""
+        cfg = self.config
+        if cfg.tiling == 'domains':
+            return list(cfg.crop_domains)
+        extent = cfg.tile_extent or union_extent(extent for _, extent in cfg.crop_domains)
+        if cfg.tiling == 'grid':
+            return tile_grid(extent, cfg.tile_size, cfg.tile_step)
+        rng = np.random.default_rng([cfg.tile_seed, date.fromisoformat(day_str).toordinal()])
+        return random_tiles(extent, cfg.tile_size, cfg.n_random_tiles, rng)
+
+    def pending_domains(self, manifest, day_str, source_tag, init_label):
+        """Return the day_domains whose unit is not yet complete (with current parameters) in the manifest."""
+        domains = self.day_domains(day_str)
+        if manifest is None:
+            return domains
+        done = manifest.completed(day_str, source_tag, init_label)
+        return [
+            (domain_name, extent)
+            for domain_name, extent in domains
+            if done.get(domain_name) != params_hash(self.unit_params(source_tag, extent))
+        ]
+
+    def record_units(self, manifest, day_str, source_tag, init_label, domains, saved):
+        if manifest is None:
+            return
+        for domain_name, extent in domains:
+            manifest.record(
+                day_str, source_tag, domain_name, init_label, self.unit_params(source_tag, extent), saved[domain_name],
+            )
+
+    def day_object_keys(self, year, month, day):
+        """Return ({init: ICON key}, MSG key) of the merged day files in the buckets."""
+        cfg = self.config
+        month = f"{month:02d}"
+        icon_keys = {
+            init: f"{cfg.icon_basename}_{year:04d}{month}{day:02d}_{init}.nc"
+            for init in cfg.icon_initialization_hours
+        }
+        file_msg = f"{cfg.msg_path_dir}/{year:04d}/{month}/{cfg.msg_basename}_{year:04d}-{month}-{day:02d}.nc"
+        return icon_keys, file_msg
+
+    def icon_lead_hours(self, timestamp, file_date, init):
+        """Lead time in hours of an ICON valid time for the `init` run of `file_date`."""
+        init_time = np.datetime64(f"{file_date}T{init}:00")
+        return float((np.datetime64(timestamp) - init_time) / np.timedelta64(1, 'h'))
+
+    def shortest_lead_init(self, timestamp, file_date):
+        """
+        The configured init of `file_date` with the shortest lead (>= 1 h) at `timestamp`.
+        Falls back to the earliest init when no init leads the timestamp by an hour.
+        """
+        leads = {init: self.icon_lead_hours(timestamp, file_date, init) for init in self.config.icon_initialization_hours}
+        ahead = {init: lead for init, lead in leads.items() if lead >= 1}
+        if ahead:
+            return min(ahead, key=ahead.get)
+        return max(leads, key=leads.get)
+
+    def paired_icon_hours(self, times, file_date, init):
+        """
+        Hours of the `init` file of `file_date` to crop: those paired with `init`
+        (shortest_lead_init). With 15-minute slots, the slot grid of the day is
+        split between the inits the same way and each init also keeps the hours
+        bracketing its slots, e.g. with inits 00 and 12 the 00 run keeps 13 UTC to
+        fill 12:15-12:45, which are too close to 12 UTC for the 12 run.
+        """
+        times = np.sort(np.asarray(times))
+        if self.config.msg_time_resolution == 'hourly':
+            return [t for t in times if self.shortest_lead_init(t, file_date) == init]
+
+        keep = set()
+        for t0, t1 in zip(times, times[1:]):
+            slots = np.arange(t0, t1 + np.timedelta64(1, 'm'), np.timedelta64(15, 'm'))
+            if any(self.shortest_lead_init(t, file_date) == init for t in slots):
+                keep.update((t0, t1))
+        keep.update(t for t in times if self.shortest_lead_init(t, file_date) == init)
+        return sorted(keep)
+
+    def iter_prefetched_days(self, day_list, depth, manifest=None):
+        """
+        Yield ((year, month, day), ({init: my_obj_icon}, my_obj_msg)) in order while the
+        objects of the next `depth` days are downloaded on I/O threads.
+
+        At most depth + 1 days are held in memory: the current one plus the `depth`
+        days downloading behind it (depth >= 1; the next day is submitted once the
+        current one is taken from the queue).
+        The ICON objects of all inits and the MSG object of a day download in parallel.
+        Sources/inits with no pending manifest units are not fetched (their object is None).
+        If a fetch of a day raises, the exception is yielded in place of its objects
+        (the day's other objects are closed) so the caller fails that day only.
+        """
+        cfg = self.config
+        day_iter = iter(day_list)
+        pending = deque()
+        n_objects = len(cfg.icon_initialization_hours) + 1
+
+        with ThreadPoolExecutor(max_workers=n_objects * depth, thread_name_prefix='prefetch') as io_pool:
+
+            def _submit_next():
+                ymd = next(day_iter, None)
+                if ymd is None:
+                    return
+                icon_keys, file_msg = self.day_object_keys(*ymd)
+                day_str = f"{ymd[0]:04d}-{ymd[1]:02d}-{ymd[2]:02d}"
+                fut_icon = {}
+                fut_msg = None
+                for init, file_icon in icon_keys.items():
+                    if self.pending_domains(manifest, day_str, 'ICON', init):
+                        fut_icon[init] = io_pool.submit(
+                            self.fetch_day_object, file_icon, S3_BUCKET_ICON, cfg.stream_icon, day_str, 'ICON',
+                        )
+                if self.pending_domains(manifest, day_str, 'MSG', self.msg_init_label()):
+                    fut_msg = io_pool.submit(
+                        self.fetch_day_object, file_msg, S3_BUCKET_MSG, cfg.stream_msg, day_str, 'MSG',
                     )
+                pending.append((ymd, fut_icon, fut_msg))
 
-                has_nan = any(xr.DataArray.isnull(ds_extent_crop[var]).any() for var in ds_extent_crop.data_vars)
-                if has_nan:
-                    print(f"[{source_tag}] NaN values detected at {timestamp}; skipping")
-                    continue
+            for _ in range(depth):
+                _submit_next()
 
-                if source_tag == 'ICON':
-                    filepath = (
-                        f"{outpath}/ICON500m_{cloud_prm[0].split('_')[-1]}_{cma_var}_"
-                        f"{file_date.replace('-', '')}_{init_label}_{t_date}_{t_hour}_{domain_name}.{file_extension}"
+            while pending:
+                ymd, fut_icon, fut_msg = pending.popleft()
+                try:
+                    objects = (
+                        {init: fut.result() for init, fut in fut_icon.items()},
+                        fut_msg.result() if fut_msg is not None else None,
                     )
+                except Exception as e:
+                    day_str = f"{ymd[0]:04d}-{ymd[1]:02d}-{ymd[2]:02d}"
+                    fetched = [(fut, 'ICON') for fut in fut_icon.values()] + [(fut_msg, 'MSG')]
+                    for fut, source_tag in fetched:
+                        if fut is not None and fut.exception() is None:
+                            self.close_day_object(fut.result(), day_str, source_tag)
+                    objects = e
+                _submit_next()
+                yield ymd, objects
+                del objects
+
+    def process_icon_init(self, day_str, init, file_icon, my_obj_icon, domains, manifest, summary):
+        """
+        Crop the valid hours of one ICON init file that are paired with this init
+        (shortest lead, see shortest_lead_init). Returns the sanity-plot panels.
+        """
+        cfg = self.config
+        icon_panels = {}
+        if not domains:
+            print(f"[ICON] {day_str} init {init} already complete in manifest; skipping")
+            return icon_panels
+        if my_obj_icon is None:
+            print(f"[ICON] missing: {file_icon}")
+            summary['missing'].append(file_icon)
+            return icon_panels
+
+        ds_icon = None
+        try:
+            ds_icon = open_day_object(my_obj_icon)
+            required_icon = cfg.cloud_prm_icon + [cfg.cma_icon]
+            missing_icon = [v for v in required_icon if v not in ds_icon]
+            if missing_icon:
+                print(f"[ICON] skipping {file_icon}: missing variables {missing_icon}")
+                return icon_panels
+
+            paired = self.paired_icon_hours(ds_icon.time.values, day_str, init)
+            if not paired:
+                print(f"[ICON] {file_icon}: every hour is covered by a shorter-lead init")
+                self.record_units(manifest, day_str, 'ICON', init, domains, {name: [] for name, _ in domains})
+                return icon_panels
+            icon_panels, icon_saved = self.crop_day_dataset(
+                ds_day=ds_icon.sel(time=paired),
+                source_tag='ICON',
+                cloud_prm=cfg.cloud_prm_icon,
+                cma_var=cfg.cma_icon,
+                cma_th=cfg.cloud_threshold_icon,
+                file_date=day_str,
+                init_label=init,
+                domains=domains,
+                threshold_sweep=cfg.cloud_threshold_sweep_icon,
+            )
+            summary['icon_saved'] += sum(len(files) for files in icon_saved.values())
+            self.record_units(manifest, day_str, 'ICON', init, domains, icon_saved)
+        finally:
+            if ds_icon is not None:
+                ds_icon.close()
+            self.close_day_object(my_obj_icon, day_str, 'ICON')
+        return icon_panels
+
+    def process_day(self, year, month, day, objects=None, manifest=None):
+        """
+        Download, crop and save ICON and MSG for one day. Returns a per-day summary dict.
+
+        `objects` is an already downloaded ({init: my_obj_icon}, my_obj_msg) pair, e.g. from
+        iter_prefetched_days; when None the objects are read from S3 here.
+        With a manifest, only domains without a completed unit are cropped, and a
+        source/init whose units are all complete is skipped without reading it.
+        """
+        cfg = self.config
+        icon_keys, file_msg = self.day_object_keys(year, month, day)
+        month = f"{month:02d}"
+        day_str = f"{year:04d}-{month}-{day:02d}"
+        summary = {'day': day_str, 'icon_saved': 0, 'msg_saved': 0, 'missing': [], 'skipped_units': 0}
+
+        print(f"Day {day_str} | ICON: {', '.join(icon_keys.values())} | MSG: {file_msg}")
+
+        icon_domains = {init: self.pending_domains(manifest, day_str, 'ICON', init) for init in icon_keys}
+        msg_domains = self.pending_domains(manifest, day_str, 'MSG', self.msg_init_label())
+        summary['skipped_units'] = (
+            (len(icon_keys) + 1) * len(self.day_domains(day_str))
+            - sum(len(domains) for domains in icon_domains.values()) - len(msg_domains)
+        )
+
+        icon_panels = {}
+        msg_panels = {}
+        if objects is None:
+            objects = (
+                {
+                    init: self.fetch_day_object(file_icon, S3_BUCKET_ICON, cfg.stream_icon, day_str, 'ICON')
+                    for init, file_icon in icon_keys.items()
+                    if icon_domains[init]
+                },
+                self.fetch_day_object(file_msg, S3_BUCKET_MSG, cfg.stream_msg, day_str, 'MSG') if msg_domains else None,
+            )
+        icon_objects, my_obj_msg = objects
+        del objects
+
+        for init, file_icon in icon_keys.items():
+            icon_panels.update(self.process_icon_init(
+                day_str, init, file_icon, icon_objects.pop(init, None), icon_domains[init], manifest, summary,
+            ))
+
+        if not msg_domains:
+            print(f"[MSG] {day_str} already complete in manifest; skipping")
+        elif my_obj_msg is not None:
+            ds_msg = None
+            try:
+                ds_msg = open_day_object(my_obj_msg)
+                required_msg = cfg.cloud_prm_msg + [cfg.cma_msg]
+                missing_msg = [v for v in required_msg if v not in ds_msg]
+                if missing_msg:
+                    print(f"[MSG] skipping {file_msg}: missing variables {missing_msg}")
                 else:
-                    filepath = (
-                        f"{outpath}/MSG_{cloud_prm[0].split('_')[-1]}_{cma_var}_"
-                        f"{t_date}_{t_hour}_{domain_name}.{file_extension}"
+                    #apply closing algorithm (structure 3x3 to cma variable only),
+                    #restricted to the cropped hours and domains
+                    ds_msg_closed = self.close_cloud_mask(
+                        ds_msg, cfg.cma_msg, day_str, msg_domains, structure=np.ones((1, 3, 3), dtype=np.uint8),
                     )
-                encoding = {
-                    var: {
-                        'zlib': True,
-                        'complevel': 4,
-                        'dtype': ds_extent_crop[var].dtype.name,
-                    }
-                    for var in ds_extent_crop.data_vars
-                }
-                ds_extent_crop.to_netcdf(filepath, encoding=encoding, engine='h5netcdf')
-                print(f"[{source_tag}] saved: {filepath}")
+                    msg_panels, msg_saved = self.crop_day_dataset(
+                        ds_day=ds_msg_closed,
+                        source_tag='MSG',
+                        cloud_prm=cfg.cloud_prm_msg,
+                        cma_var=cfg.cma_msg,
+                        cma_th=cfg.cloud_threshold_msg,
+                        file_date=day_str,
+                        init_label=self.msg_init_label(),
+                        domains=msg_domains,
+                    )
+                    summary['msg_saved'] = sum(len(files) for files in msg_saved.values())
+                    self.record_units(manifest, day_str, 'MSG', self.msg_init_label(), msg_domains, msg_saved)
+            finally:
+                if ds_msg is not None:
+                    ds_msg.close()
+                self.close_day_object(my_obj_msg, day_str, 'MSG')
+                del my_obj_msg
+        else:
+            print(f"[MSG] missing: {file_msg}")
+            summary['missing'].append(file_msg)
+
+        if cfg.save_sanity_plot and (icon_panels or msg_panels):
+            for hour_key in sorted(set(icon_panels) | set(msg_panels)):
+                ip = icon_panels.get(hour_key)
+                mp = msg_panels.get(hour_key)
+                if ip and mp:
+                    plot_sanity_triptych_cartopy(
+                        da_before_mask=ip[0], da_after_mask=ip[1], da_after_resample=ip[2],
+                        var_name=ip[3],
+                        da_before_mask_2=mp[0], da_after_mask_2=mp[1], da_after_resample_2=mp[2],
+                        var_name_2=mp[3],
+                        out_dir=cfg.sanity_plot_outpath,
+                        plot_tag=f"{day_str}_{hour_key}",
+                    )
+                elif ip:
+                    plot_sanity_triptych_cartopy(
+                        da_before_mask=ip[0], da_after_mask=ip[1], da_after_resample=ip[2],
+                        var_name=ip[3],
+                        out_dir=cfg.sanity_plot_outpath,
+                        plot_tag=f"ICON_{day_str}_{hour_key}",
+                    )
+                elif mp:
+                    plot_sanity_triptych_cartopy(
+                        da_before_mask=mp[0], da_after_mask=mp[1], da_after_resample=mp[2],
+                        var_name=mp[3],
+                        out_dir=cfg.sanity_plot_outpath,
+                        plot_tag=f"MSG_{day_str}_{hour_key}",
+                    )
+
+        return summary
+
+    def open_manifest(self):
+        return CropManifest(self.config.manifest_path) if self.config.manifest_path else None
 
+    def run_days(self, day_list, manifest=None):
+        """Process consecutive days with prefetching; failures are reported in the summaries instead of raised."""
+        summaries = []
+        if self.config.prefetch_days > 0:
+            day_stream = self.iter_prefetched_days(day_list, self.config.prefetch_days, manifest=manifest)
+        else:
+            day_stream = ((ymd, None) for ymd in day_list)
+
+        for (year, month, day), objects in day_stream:
+            day_str = f"{year:04d}-{month:02d}-{day:02d}"
+            try:
+                if isinstance(objects, Exception):
+                    # Prefetch of this day failed: same per-day failure as a fetch inside process_day.
+                    raise objects
+                with self.timer.stage('day', day_str):
+                    summaries.append(self.process_day(year, month, day, objects=objects, manifest=manifest))
+            except Exception as e:
+                summaries.append(_failed_day_summary(year, month, day, e))
+            finally:
+                self.timer.flush(day_str)
+            del objects
+        return summaries
+
+    def run(self, date_range):
+        """
+        Crop every day of the inclusive (start, end) `date_range` and print the run summary.
+
+        With n_workers > 1 contiguous chunks of days go to a process pool whose
+        workers each build their own CropJob from this config. Returns the per-day summaries.
+        """
+        cfg = self.config
+        day_list = days_in_range(date_range)
+        os.makedirs(cfg.outpath, exist_ok=True)
+        for th in cfg.cloud_threshold_sweep_icon or []:
+            os.makedirs(self.crop_outdir(cfg.cma_icon, th), exist_ok=True)
+
+        trace_path = None
+        if cfg.instrument:
+            os.makedirs(cfg.trace_dir, exist_ok=True)
+            trace_path = f"{cfg.trace_dir}/crop_trace_{datetime.now():%Y%m%dT%H%M%S}.jsonl"
+            self.timer = StageTimer(trace_path)
+
+        summaries = []
+        if cfg.n_workers > 1:
+            # Contiguous chunks keep prefetching effective inside each worker.
+            day_chunks = [day_list[i:i + cfg.days_per_task] for i in range(0, len(day_list), cfg.days_per_task)]
+            with ProcessPoolExecutor(max_workers=cfg.n_workers, initializer=_init_worker, initargs=(cfg, trace_path)) as pool:
+                futures = {pool.submit(_run_days_worker, chunk): chunk for chunk in day_chunks}
+                for future in as_completed(futures):
+                    try:
+                        summaries.extend(future.result())
+                    except Exception as e:
+                        # A worker died (e.g. BrokenProcessPool after an OOM kill): fail that
+                        # chunk's days and keep collecting the others.
+                        summaries.extend(_failed_day_summary(*ymd, e) for ymd in futures[future])
+        else:
+            manifest = self.open_manifest()
+            try:
+                summaries = self.run_days(day_list, manifest=manifest)
             finally:
-                if ds_extent_crop is not None:
-                    ds_extent_crop.close()
-                if ds_time_mask is not None:
-                    ds_time_mask.close()
-                if ds_time_var is not None:
-                    ds_time_var.close()
+                if manifest is not None:
+                    manifest.close()
 
-        return panels_by_hour
+        print_run_summary(summaries)
+        if trace_path is not None and os.path.exists(trace_path):
+            print_trace_summary(trace_path)
+        return summaries
 
-    finally:
-        if ds_day_mask is not None:
-            ds_day_mask.close()
-        if ds_day_var is not None:
-            ds_day_var.close()
 
+_worker_job = None
+_worker_manifest = None
 
-outpath = f'/data1/crops/teamx_Apr-Sep_2025_icon_msg/{file_extension}/1'
-os.makedirs(outpath, exist_ok=True)
-sanity_plot_outpath = "/data1/crops/teamx_Apr-Sep_2025_icon_msg/sanity_plots"
 
-for year in years:
-    for month in months:
-        month = f"{month:02d}"
-        for day in days:
-            day_str = f"{year:04d}-{month}-{day:02d}"
+def _init_worker(config, trace_path=None):
+    """Pool initializer: give each worker process its own CropJob (S3 client, timer) and manifest connection."""
+    global _worker_job, _worker_manifest
+    _worker_job = CropJob(config, s3=init_s3(), trace_path=trace_path)
+    _worker_manifest = _worker_job.open_manifest()
 
-            file_icon = f"{icon_basename}_{year:04d}{month}{day:02d}_{icon_initialization_hour}.nc"
-            file_msg = f"{msg_path_dir}/{year:04d}/{month}/{msg_basename}_{year:04d}-{month}-{day:02d}.nc"
 
-            print(f"Day {day_str} | ICON: {file_icon} | MSG: {file_msg}")
+def _run_days_worker(day_chunk):
+    """Pool task: process a chunk of consecutive days with the worker's CropJob."""
+    return _worker_job.run_days(day_chunk, manifest=_worker_manifest)
 
-            my_obj_icon = read_file(s3, file_icon, S3_BUCKET_ICON)
-            my_obj_msg = read_file(s3, file_msg, S3_BUCKET_MSG)
 
-            if my_obj_icon is not None:
-                icon_panels = {}
-                ds_icon = None
-                try:
-                    ds_icon = xr.open_dataset(io.BytesIO(my_obj_icon))
-                    required_icon = cloud_prm_icon + [cma_icon]
-                    missing_icon = [v for v in required_icon if v not in ds_icon]
-                    if missing_icon:
-                        print(f"[ICON] skipping {file_icon}: missing variables {missing_icon}")
-                    else:
-                        icon_panels = process_day_dataset(
-                            ds_day=ds_icon,
-                            source_tag='ICON',
-                            cloud_prm=cloud_prm_icon,
-                            cma_var=cma_icon,
-                            cma_th=cloud_threshold_icon,
-                            file_date=day_str,
-                            init_label=icon_initialization_hour,
-                        ) or {}
-                finally:
-                    if ds_icon is not None:
-                        ds_icon.close()
-                    del my_obj_icon
-            else:
-                print(f"[ICON] missing: {file_icon}")
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Crop ICON and MSG day files from the S3 buckets into fixed-size domain crops"
+    )
+    parser.add_argument(
+        "--config",
+        default=None,
+        help="YAML file with CropConfig settings; settings not given keep their defaults",
+    )
+    parser.add_argument("--start", default="2025-04-01", help="First day to crop (YYYY-MM-DD)")
+    parser.add_argument("--end", default="2025-04-30", help="Last day to crop, inclusive (YYYY-MM-DD)")
+    parser.add_argument("--workers", type=int, default=None, help="Override n_workers of the config")
+    parser.add_argument("--list-bucket", action="store_true", help="List the ICON bucket before cropping")
+    return parser.parse_args(argv)
 
-            if my_obj_msg is not None:
-                msg_panels = {}
-                ds_msg = None
-                try:
-                    ds_msg = xr.open_dataset(io.BytesIO(my_obj_msg))
-                    required_msg = cloud_prm_msg + [cma_msg]
-                    missing_msg = [v for v in required_msg if v not in ds_msg]
-                    if missing_msg:
-                        print(f"[MSG] skipping {file_msg}: missing variables {missing_msg}")
-                    else:
-                        #apply closing algorithm (structure 3x3 to cma variable only)
-                        cma_values = ds_msg['cma'].values
-                        closed_cma = binary_closing(cma_values, structure=np.ones((1, 3, 3), dtype=np.uint8))
-                        ds_msg['cma'] = (('time', 'lat', 'lon'), closed_cma)
-                        msg_panels = process_day_dataset(
-                            ds_day=ds_msg,
-                            source_tag='MSG',
-                            cloud_prm=cloud_prm_msg,
-                            cma_var=cma_msg,
-                            cma_th=cloud_threshold_msg,
-                            file_date=day_str,
-                            init_label='hourly',
-                        ) or {}
-                finally:
-                    if ds_msg is not None:
-                        ds_msg.close()
-                    del my_obj_msg
-            else:
-                print(f"[MSG] missing: {file_msg}")
-
-            if save_sanity_plot and (icon_panels or msg_panels):
-                for hour_key in sorted(set(icon_panels) | set(msg_panels)):
-                    ip = icon_panels.get(hour_key)
-                    mp = msg_panels.get(hour_key)
-                    if ip and mp:
-                        plot_sanity_triptych_cartopy(
-                            da_before_mask=ip[0], da_after_mask=ip[1], da_after_resample=ip[2],
-                            var_name=ip[3],
-                            da_before_mask_2=mp[0], da_after_mask_2=mp[1], da_after_resample_2=mp[2],
-                            var_name_2=mp[3],
-                            out_dir=sanity_plot_outpath,
-                            plot_tag=f"{day_str}_{hour_key}",
-                        )
-                    elif ip:
-                        plot_sanity_triptych_cartopy(
-                            da_before_mask=ip[0], da_after_mask=ip[1], da_after_resample=ip[2],
-                            var_name=ip[3],
-                            out_dir=sanity_plot_outpath,
-                            plot_tag=f"ICON_{day_str}_{hour_key}",
-                        )
-                    elif mp:
-                        plot_sanity_triptych_cartopy(
-                            da_before_mask=mp[0], da_after_mask=mp[1], da_after_resample=mp[2],
-                            var_name=mp[3],
-                            out_dir=sanity_plot_outpath,
-                            plot_tag=f"MSG_{day_str}_{hour_key}",
-                        )
 
-#nohup 2050506
+def main(argv=None):
+    args = parse_args(argv)
+    config = CropConfig.from_yaml(args.config) if args.config else CropConfig()
+    if args.workers is not None:
+        config = replace(config, n_workers=args.workers)
+
+    job = CropJob(config)
+    if args.list_bucket:
+        print(f"Bucket contents before upload:")
+        response = job.s3.list_objects(Bucket=S3_BUCKET_ICON)
+        for item in response['Contents']:
+            print(item['Key'])
+
+    job.run((args.start, args.end))
 
-#east 2052445
 
-#west 2052974
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import json
+import sqlite3
+import hashlib
+from datetime import datetime, timezone
+
+
+def params_hash(params):
+    """Stable hash of a JSON-serializable parameter dict."""
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class CropManifest:
+    """
+    SQLite manifest of completed crop units.
+
+    A unit is one (day, source, domain, init) combination. It is recorded once
+    all of its crops have been written, together with the generating parameters
+    and the produced files. A unit only counts as complete for the same
+    parameter hash, so changing a setting makes the affected units run again.
+    Several worker processes can share one manifest file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS units (
+                day TEXT NOT NULL,
+                source TEXT NOT NULL,
+                domain TEXT NOT NULL,
+                init TEXT NOT NULL,
+                params_hash TEXT NOT NULL,
+                params TEXT NOT NULL,
+                n_files INTEGER NOT NULL,
+                files TEXT NOT NULL,
+                completed_at TEXT NOT NULL,
+                PRIMARY KEY (day, source, domain, init)
+            )
+            """
+        )
+        self.conn.commit()
+
+    def completed(self, day, source, init):
+        """Return {domain: params_hash} of the units already recorded for (day, source, init)."""
+        rows = self.conn.execute(
+            "SELECT domain, params_hash FROM units WHERE day = ? AND source = ? AND init = ?",
+            (day, source, init),
+        ).fetchall()
+        return dict(rows)
+
+    def record(self, day, source, domain, init, params, files):
+        """Mark a unit as complete (replacing any earlier record for it)."""
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO units VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    day,
+                    source,
+                    domain,
+                    init,
+                    params_hash(params),
+                    json.dumps(params, sort_keys=True, default=str),
+                    len(files),
+                    json.dumps(sorted(files)),
+                    datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                ),
+            )
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,218 @@
+import os
+import fcntl
+from contextlib import contextmanager
+
+import numpy as np
+import netCDF4
+import xarray as xr
+
+# Per-sample index coordinates of a crop stack.
+STACK_INDEX = ('timestamp', 'source', 'domain', 'init')
+TIMESTAMP_UNITS = 'seconds since 1970-01-01 00:00:00'
+
+
+def build_crop_stack(crops):
+    """
+    Stack 2-D (lat, lon) crop datasets into one dataset with dims (sample, lat, lon).
+
+    `crops` is a list of (ds_crop, meta) pairs, meta holding the STACK_INDEX
+    values of the crop. Each crop keeps its own grid as the per-sample
+    coordinates latitude(sample, lat) and longitude(sample, lon).
+    Clips (time, lat, lon) stack to (sample, time, lat, lon); the timestamp of
+    a clip sample is its first frame. A channel dim of multi-channel crops is
+    kept after time, with its channel coordinate. If the metas hold a
+    lead_time_hours (ICON crops) or the day of the file a crop was cut from
+    (day, 'YYYY-MM-DD'), they become per-sample coordinates.
+    """
+    if not crops:
+        raise ValueError("No crops to stack")
+
+    first, _ = crops[0]
+    var_names = list(first.data_vars)
+    crop_dims = tuple(d for d in ('time', 'channel', 'lat', 'lon') if d in first[var_names[0]].dims)
+    data_vars = {
+        var: (
+            ('sample',) + crop_dims,
+            np.stack([ds_crop[var].transpose(*crop_dims).values for ds_crop, _ in crops]),
+            first[var].attrs,
+        )
+        for var in var_names
+    }
+    coords = {
+        'latitude': (('sample', 'lat'), np.stack([ds_crop['lat'].values for ds_crop, _ in crops])),
+        'longitude': (('sample', 'lon'), np.stack([ds_crop['lon'].values for ds_crop, _ in crops])),
+        'timestamp': ('sample', np.array([meta['timestamp'] for _, meta in crops], dtype='datetime64[ns]')),
+    }
+    for name in STACK_INDEX[1:]:
+        coords[name] = ('sample', np.array([str(meta[name]) for _, meta in crops], dtype=object))
+    if 'day' in crops[0][1]:
+        coords['day'] = ('sample', np.array([str(meta['day']) for _, meta in crops], dtype=object))
+    if 'lead_time_hours' in crops[0][1]:
+        coords['lead_time_hours'] = ('sample', np.array([meta['lead_time_hours'] for _, meta in crops], dtype='float64'))
+    if 'channel' in crop_dims:
+        coords['channel'] = first['channel'].values
+
+    return xr.Dataset(data_vars, coords=coords, attrs=first.attrs)
+
+
+@contextmanager
+def _file_lock(path):
+    """
+    Exclusive lock next to `path`, so pool workers can append to the same stack.
+
+    The lock file is removed on release. A waiter that wakes up holding the lock
+    of an already removed file sees that the path no longer names its inode and
+    locks again, so removing it never lets two writers in at once.
+    """
+    lock_path = f"{path}.lock"
+    while True:
+        lock_file = open(lock_path, 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if os.fstat(lock_file.fileno()).st_ino == os.stat(lock_path).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        lock_file.close()
+    try:
+        yield
+    finally:
+        os.remove(lock_path)
+        lock_file.close()
+
+
+def _epoch_seconds(timestamps):
+    return np.asarray(timestamps).astype('datetime64[s]').astype('int64')
+
+
+def _sample_days(days, timestamps):
+    """Per-sample day of a stack; stacks written without a day coordinate fall back to the timestamp's date."""
+    if days is not None:
+        return [str(day) for day in days]
+    return np.datetime_as_string(np.asarray(timestamps).astype('datetime64[s]'), unit='D').tolist()
+
+
+def _unit_keys(ds):
+    """(day, source, domain, init) unit of every sample of a stack dataset."""
+    days = _sample_days(ds['day'].values if 'day' in ds.coords else None, ds['timestamp'].values)
+    return list(zip(days, ds['source'].values, ds['domain'].values, ds['init'].values))
+
+
+def _sample_keys(ds):
+    """(timestamp, source, domain, init) key of every sample of a stack dataset."""
+    return list(zip(
+        _epoch_seconds(ds['timestamp'].values).tolist(),
+        ds['source'].values, ds['domain'].values, ds['init'].values,
+    ))
+
+
+def _carry_over_samples(ds_stack, path):
+    """
+    `ds_stack` preceded by the samples of the existing stack at `path` whose
+    (day, source, domain, init) unit is not in `ds_stack`, so rewriting a stack for
+    the units re-cropped in this run keeps the other units' crops and drops every
+    old crop of the re-cropped ones (also those the new settings no longer produce).
+    """
+    replaced_units = set(_unit_keys(ds_stack))
+    replaced_samples = set(_sample_keys(ds_stack))
+    with xr.open_dataset(path) as ds_old:
+        keep = [
+            i for i, (unit, key) in enumerate(zip(_unit_keys(ds_old), _sample_keys(ds_old)))
+            if unit not in replaced_units and key not in replaced_samples
+        ]
+        if not keep:
+            return ds_stack
+        ds_old = ds_old.isel(sample=keep).load()
+    for var in ds_old.variables.values():
+        var.encoding = {}
+    if 'day' in ds_stack.coords and 'day' not in ds_old.coords:
+        days = _sample_days(None, ds_old['timestamp'].values)
+        ds_old = ds_old.assign_coords(day=('sample', np.array(days, dtype=object)))
+    if 'lead_time_hours' in ds_stack.coords and 'lead_time_hours' not in ds_old.coords:
+        ds_old = ds_old.assign_coords(lead_time_hours=('sample', np.full(ds_old.sizes['sample'], np.nan)))
+    return xr.concat([ds_old, ds_stack], dim='sample', data_vars='minimal', coords='minimal', compat='override')
+
+
+def _append_samples(ds_stack, path):
+    """
+    Append `ds_stack` along the unlimited `sample` dimension of the stack at `path`.
+
+    Returns the number of samples appended, or None when the stack holds samples
+    of the units being written (or predates the day coordinate) and has to be
+    rewritten through _carry_over_samples instead.
+    """
+    with netCDF4.Dataset(path, 'a') as nc:
+        if 'day' in ds_stack.coords and 'day' not in nc.variables:
+            return None
+        # Timestamps are stored as int64 seconds since the epoch (TIMESTAMP_UNITS).
+        timestamps = np.asarray(nc['timestamp'][:])
+        sources, domains, inits = nc['source'][:], nc['domain'][:], nc['init'][:]
+        days = _sample_days(nc['day'][:] if 'day' in nc.variables else None, timestamps.astype('datetime64[s]'))
+        if (
+            set(zip(days, sources, domains, inits)) & set(_unit_keys(ds_stack))
+            or set(zip(timestamps.tolist(), sources, domains, inits)) & set(_sample_keys(ds_stack))
+        ):
+            return None
+
+        for dim in ('time', 'channel', 'lat', 'lon'):
+            if dim not in ds_stack.dims:
+                continue
+            existing_size = len(nc.dimensions[dim]) if dim in nc.dimensions else None
+            if existing_size != ds_stack.sizes[dim]:
+                raise ValueError(
+                    f"Cannot append to {path}: {dim} size {ds_stack.sizes[dim]} "
+                    f"!= existing {existing_size}"
+                )
+
+        n0 = len(nc.dimensions['sample'])
+        n1 = n0 + ds_stack.sizes['sample']
+        for var in ds_stack.data_vars:
+            nc[var][n0:n1] = ds_stack[var].values
+        nc['latitude'][n0:n1] = ds_stack['latitude'].values
+        nc['longitude'][n0:n1] = ds_stack['longitude'].values
+        nc['timestamp'][n0:n1] = _epoch_seconds(ds_stack['timestamp'].values)
+        for name in STACK_INDEX[1:] + ('day', 'lead_time_hours'):
+            if name in ds_stack.coords and name in nc.variables:
+                nc[name][n0:n1] = ds_stack[name].values
+        return n1 - n0
+
+
+def write_crop_stack(ds_stack, path, append=False, complevel=4, var_encoding=None):
+    """
+    Write a crop stack to `path`.
+
+    `var_encoding` adds per-variable encoding (e.g. scale_factor/add_offset
+    packing) when the file is created; appended samples are packed by netCDF4
+    with the attributes already stored in the file.
+
+    The file is (re)created keeping the samples of an existing file whose
+    (day, source, domain, init) unit is not among the new samples. With
+    append=True samples of new units are instead appended along the unlimited
+    `sample` dimension; the file is only rewritten when it already holds some of
+    the units, so a unit re-cropped with new settings replaces all its old crops.
+    Returns the number of samples written.
+    """
+    with _file_lock(path):
+        if append and os.path.exists(path):
+            n_appended = _append_samples(ds_stack, path)
+            if n_appended is not None:
+                return n_appended
+
+        n_new = int(ds_stack.sizes['sample'])
+        if os.path.exists(path):
+            ds_stack = _carry_over_samples(ds_stack, path)
+        encoding = {
+            var: {
+                'zlib': True,
+                'complevel': complevel,
+                # One chunk per sample: reading the stack is a sequence of whole-crop reads.
+                'chunksizes': (1,) + ds_stack[var].shape[1:],
+                **(var_encoding or {}).get(var, {}),
+            }
+            for var in ds_stack.data_vars
+        }
+        encoding['timestamp'] = {'units': TIMESTAMP_UNITS, 'dtype': 'int64'}
+        tmp_path = f"{path}.tmp"
+        ds_stack.to_netcdf(tmp_path, encoding=encoding, engine='netcdf4', unlimited_dims=['sample'])
+        os.replace(tmp_path, path)
+        return n_new
@@ -0,0 +1,366 @@
+import os
+import hashlib
+
+import numpy as np
+
+# In-memory gather-index cache shared by every timestamp/day of a run in this process.
+_gather_index_cache = {}
+
+
+def _unique_sorted_index(coord, dim_name):
+    """
+    Indices into `coord` that keep finite values, sorted ascending, duplicates dropped.
+
+    This is the coordinate clean-up that xarray interp needs, expressed as
+    positions into the original coordinate instead of a re-indexed dataset.
+    """
+    coord = np.asarray(coord)
+    finite_idx = np.where(np.isfinite(coord))[0]
+    if finite_idx.size == 0:
+        raise ValueError(f"No finite values found on coordinate '{dim_name}'")
+
+    order = np.argsort(coord[finite_idx])
+    sorted_idx = finite_idx[order]
+
+    _, unique_idx = np.unique(coord[sorted_idx], return_index=True)
+    if unique_idx.size < sorted_idx.size:
+        sorted_idx = sorted_idx[np.sort(unique_idx)]
+
+    return sorted_idx
+
+
+def _nearest_index(src, target):
+    """
+    Nearest-neighbour positions of `target` in ascending `src`.
+
+    Ties go to the lower neighbour and out-of-range targets clamp to the edges,
+    matching interp(method='nearest', fill_value='extrapolate').
+    """
+    if src.size == 1:
+        return np.zeros(target.shape, dtype=np.intp)
+    midpoints = 0.5 * (src[1:] + src[:-1])
+    return np.searchsorted(midpoints, target, side='left').astype(np.intp)
+
+
+def nearest_gather_index(lon, lat, extent, x_pixel, y_pixel):
+    """
+    Build the nearest-neighbour gather index that resample_by_extent applies.
+
+    Returns (lat_idx, lon_idx, target_lat, target_lon): `data[..., lat_idx, :][..., lon_idx]`
+    on an array laid out on the original (lat, lon) coordinates gives the
+    (y_pixel, x_pixel) resampled crop on the target grid.
+    """
+    lonmin, lonmax, latmin, latmax = extent
+
+    lon = np.asarray(lon)
+    lat = np.asarray(lat)
+    if lon.size == 0 or lat.size == 0:
+        raise ValueError(f"Empty crop for extent: {extent}")
+
+    lon_sel = _unique_sorted_index(lon, 'lon')
+    lat_sel = _unique_sorted_index(lat, 'lat')
+    lon_src = lon[lon_sel]
+    lat_src = lat[lat_sel]
+
+    src_lon_min, src_lon_max = float(lon_src[0]), float(lon_src[-1])
+    src_lat_min, src_lat_max = float(lat_src[0]), float(lat_src[-1])
+
+    lon_lo = max(min(lonmin, lonmax), src_lon_min)
+    lon_hi = min(max(lonmin, lonmax), src_lon_max)
+    lat_lo = max(min(latmin, latmax), src_lat_min)
+    lat_hi = min(max(latmin, latmax), src_lat_max)
+
+    if lon_lo >= lon_hi or lat_lo >= lat_hi:
+        raise ValueError(
+            f"No overlap between requested extent {extent} and source bounds "
+            f"lon[{src_lon_min}, {src_lon_max}] lat[{src_lat_min}, {src_lat_max}]"
+        )
+
+    target_lon = np.linspace(lon_lo, lon_hi, x_pixel)
+    target_lat = np.linspace(lat_lo, lat_hi, y_pixel)
+
+    lon_idx = lon_sel[_nearest_index(lon_src, target_lon)]
+    lat_idx = lat_sel[_nearest_index(lat_src, target_lat)]
+
+    return lat_idx, lon_idx, target_lat, target_lon
+
+
+def extent_window(lon, lat, extent, halo=0):
+    """
+    Index window (lat_slice, lon_slice) covering `extent` on 1-D lon/lat
+    coordinates, widened by `halo` pixels on every side and clipped to the grid.
+    Returns None if no coordinate falls inside the extent.
+    """
+    lonmin, lonmax, latmin, latmax = extent
+    slices = []
+    for coord, lo, hi in ((lat, latmin, latmax), (lon, lonmin, lonmax)):
+        coord = np.asarray(coord)
+        inside = np.where((coord >= min(lo, hi)) & (coord <= max(lo, hi)))[0]
+        if inside.size == 0:
+            return None
+        slices.append(slice(max(inside[0] - halo, 0), min(inside[-1] + halo + 1, coord.size)))
+    return tuple(slices)
+
+
+def grid_fingerprint(lon, lat):
+    """Stable hash of the source lon/lat coordinates (values, dtype and size)."""
+    h = hashlib.sha1()
+    for coord in (lon, lat):
+        coord = np.ascontiguousarray(coord)
+        h.update(f"{coord.dtype.str}{coord.shape}".encode())
+        h.update(coord.tobytes())
+    return h.hexdigest()
+
+
+def cached_nearest_gather_index(lon, lat, extent, x_pixel, y_pixel, cache_dir=None):
+    """
+    nearest_gather_index with a cache keyed by (grid fingerprint, extent, x_pixel, y_pixel).
+
+    Indices are kept in memory for the life of the process and, if `cache_dir`
+    is given, stored there as .npz so later runs and other workers reuse them.
+    """
+    key = (grid_fingerprint(lon, lat), tuple(float(e) for e in extent), int(x_pixel), int(y_pixel))
+    cached = _gather_index_cache.get(key)
+    if cached is not None:
+        return cached
+
+    cache_file = None
+    if cache_dir is not None:
+        key_hash = hashlib.sha1(repr(key).encode()).hexdigest()
+        cache_file = os.path.join(cache_dir, f"gather_index_{key_hash}.npz")
+        if os.path.exists(cache_file):
+            try:
+                with np.load(cache_file) as f:
+                    cached = (f['lat_idx'], f['lon_idx'], f['target_lat'], f['target_lon'])
+            except Exception as e:
+                print(f"Ignoring unreadable gather index cache {cache_file}: {e}")
+
+    if cached is None:
+        cached = nearest_gather_index(lon, lat, extent, x_pixel, y_pixel)
+        if cache_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write to a temporary name first so concurrent workers never read a partial file.
+            tmp_file = f"{cache_file}.{os.getpid()}.tmp.npz"
+            lat_idx, lon_idx, target_lat, target_lon = cached
+            np.savez(tmp_file, lat_idx=lat_idx, lon_idx=lon_idx, target_lat=target_lat, target_lon=target_lon)
+            os.replace(tmp_file, cache_file)
+
+    _gather_index_cache[key] = cached
+    return cached
+
+
+def is_regular_grid(coord, rtol=1e-6):
+    """True if 1-D `coord` is ascending with a constant step (up to `rtol` of the step)."""
+    step = np.diff(np.asarray(coord, dtype=float))
+    return step.size > 0 and step[0] > 0 and bool(np.all(np.abs(step - step[0]) <= rtol * step[0]))
+
+
+def window_gather_index(lon, lat, x_pixel, y_pixel):
+    """
+    nearest_gather_index of a tile window cut from a regular (is_regular_grid) grid.
+
+    extent_window keeps only the cells inside a tile, so the target grid spans
+    the window's first to last cell and the index only depends on the window
+    shape: it is computed once per (n_lat, n_lon, x_pixel, y_pixel) in index
+    space and reused for every tile of that size, wherever it sits on the grid.
+    Indices are relative to the window; target_lat/target_lon are its own.
+    """
+    lon = np.asarray(lon)
+    lat = np.asarray(lat)
+    if lon.size == 0 or lat.size == 0:
+        raise ValueError("Empty tile window")
+
+    key = ('window', lat.size, lon.size, int(x_pixel), int(y_pixel))
+    cached = _gather_index_cache.get(key)
+    if cached is None:
+        cached = tuple(
+            _nearest_index(np.arange(n, dtype=float), np.linspace(0, n - 1, n_pixel))
+            for n, n_pixel in ((lat.size, y_pixel), (lon.size, x_pixel))
+        )
+        _gather_index_cache[key] = cached
+    lat_idx, lon_idx = cached
+    return lat_idx, lon_idx, np.linspace(lat[0], lat[-1], y_pixel), np.linspace(lon[0], lon[-1], x_pixel)
+
+
+def gather_crops(cube, lat_idx, lon_idx):
+    """Apply a gather index to the two trailing (lat, lon) axes of `cube` in one fancy-index."""
+    return cube[..., lat_idx[:, None], lon_idx[None, :]]
+
+
+def mask_clear_sky(values, mask, cloud_threshold, clear_sky_fill_value):
+    """
+    Vectorized apply_cloud_mask_threshold: keep values where mask > threshold,
+    fill everything else (including NaNs) with clear_sky_fill_value.
+    """
+    out = np.where(mask > cloud_threshold, values, clear_sky_fill_value)
+    return np.where(np.isnan(out), clear_sky_fill_value, out).astype(values.dtype, copy=False)
+
+
+def timestep_validity(cubes, value_min, value_max):
+    """
+    Per-timestep pre-mask checks on (time, lat, lon) cubes, one per variable.
+
+    Returns a boolean array over time that is False where all variables are
+    all-NaN or any variable leaves its [value_min[i], value_max[i]] range.
+    """
+    n_time = cubes[0].shape[0]
+    all_nan = np.ones(n_time, dtype=bool)
+    outside = np.zeros(n_time, dtype=bool)
+    for i, cube in enumerate(cubes):
+        flat = cube.reshape(n_time, -1)
+        all_nan &= np.isnan(flat).all(axis=1)
+        with np.errstate(invalid='ignore'):
+            outside |= ((flat < value_min[i]) | (flat > value_max[i])).any(axis=1)
+    return ~(all_nan | outside)
+
+
+def _summed_area_table(mask):
+    """(time, lat + 1, lon + 1) int32 running sums of a (time, lat, lon) mask, zero-padded at the start."""
+    n_time, n_lat, n_lon = mask.shape
+    table = np.zeros((n_time, n_lat + 1, n_lon + 1), dtype=np.int32)
+    np.cumsum(mask, axis=1, dtype=np.int32, out=table[:, 1:, 1:])
+    np.cumsum(table[:, 1:, 1:], axis=2, out=table[:, 1:, 1:])
+    return table
+
+
+def _window_any_table(mask):
+    """
+    Per-timestep any() of a (time, lat, lon) mask over arbitrary windows: the
+    per-timestep any of the whole mask, and a summed-area table of only the
+    timesteps where the mask is mixed (elsewhere every window gives that any).
+    """
+    t_any = mask.any(axis=(1, 2))
+    mixed = np.where(t_any & ~mask.all(axis=(1, 2)))[0]
+    return t_any, mixed, _summed_area_table(mask[mixed])
+
+
+def _window_any(table, window):
+    t_any, mixed, area_table = table
+    (lat0, lat1), (lon0, lon1) = ((sl.start, sl.stop) for sl in window)
+    result = t_any.copy()
+    result[mixed] = (
+        area_table[:, lat1, lon1] - area_table[:, lat0, lon1] - area_table[:, lat1, lon0] + area_table[:, lat0, lon0]
+    ) > 0
+    return result
+
+
+def validity_tables(cubes, value_min, value_max):
+    """
+    Lookup tables for timestep_validity on windows of (time, lat, lon) day cubes.
+
+    The NaN and range masks are computed once on the day cubes, so
+    window_validity answers every tile (they overlap) without rescanning its
+    pixels. Only timesteps that are partly NaN or partly out of range get a
+    summed-area table; usually there are none.
+    """
+    tables = []
+    for i, cube in enumerate(cubes):
+        with np.errstate(invalid='ignore'):
+            outside = (cube < value_min[i]) | (cube > value_max[i])
+        tables.append((_window_any_table(~np.isnan(cube)), _window_any_table(outside)))
+    return tables
+
+
+def window_validity(tables, window):
+    """timestep_validity of the (lat_slice, lon_slice) `window` of the cubes behind validity_tables."""
+    n_time = tables[0][0][0].shape[0]
+    all_nan = np.ones(n_time, dtype=bool)
+    outside = np.zeros(n_time, dtype=bool)
+    for not_nan_table, outside_table in tables:
+        all_nan &= ~_window_any(not_nan_table, window)
+        outside |= _window_any(outside_table, window)
+    return ~(all_nan | outside)
+
+
+def quantization_encoding(value_min, value_max, mode):
+    """
+    NetCDF packing (scale_factor/add_offset) for a variable clipped to [value_min, value_max].
+
+    Every stored value must lie in the range, so it has to include the clear-sky
+    fill value of masked crops; values outside it wrap around in uint8.
+    Precision for the brightness-temperature range 180-320 K:
+    - 'int16': fixed 0.01 K step around the range midpoint, max rounding error 0.005 K
+      (ranges up to ~655 K wide fit in int16).
+    - 'uint8': 254 levels over the range (255 is the fill value), i.e. a step of
+      (value_max - value_min) / 254: 0.551 K for 180-320 K, max rounding error 0.28 K.
+    Returns {} for 'float' (values are stored unpacked).
+    """
+    if mode == 'float':
+        return {}
+    if mode == 'int16':
+        scale_factor = 0.01
+        if (value_max - value_min) / scale_factor > 65000:
+            raise ValueError(f"Range [{value_min}, {value_max}] too wide for int16 at {scale_factor} steps")
+        return {
+            'dtype': 'int16',
+            'scale_factor': scale_factor,
+            'add_offset': 0.5 * (value_min + value_max),
+            '_FillValue': np.int16(-32768),
+        }
+    if mode == 'uint8':
+        return {
+            'dtype': 'uint8',
+            'scale_factor': (value_max - value_min) / 254.0,
+            'add_offset': float(value_min),
+            '_FillValue': np.uint8(255),
+        }
+    raise ValueError(f"Unknown quantization mode: {mode}")
+
+
+def clip_starts(valid, times, length, step, stride=1):
+    """
+    Start indices of clips of `length` consecutive timesteps that are all valid.
+
+    `times` must advance by exactly `step` inside a clip, so a missing slot in
+    the day file never joins two non-adjacent frames. Starts are kept every
+    `stride` timesteps (counted from the first timestep of the day).
+    """
+    valid = np.asarray(valid, dtype=bool)
+    times = np.asarray(times, dtype='datetime64[ns]')
+    n_start = valid.size - length + 1
+    if n_start <= 0:
+        return np.zeros(0, dtype=np.intp)
+    ok = np.lib.stride_tricks.sliding_window_view(valid, length).all(axis=1)
+    ok &= (times[length - 1:] - times[:n_start]) == (length - 1) * np.timedelta64(step)
+    starts = np.where(ok)[0]
+    return starts[starts % stride == 0]
+
+
+def tile_grid(extent, tile_size, tile_step):
+    """
+    Regular grid of (name, extent) tiles of tile_size = (dlon, dlat) degrees,
+    placed every tile_step = (step_lon, step_lat) degrees inside `extent`.
+    Tiles are named r<row>c<col> from the south-west corner.
+    """
+    lonmin, lonmax, latmin, latmax = extent
+    # Small tolerance so a tile ending exactly on the extent edge is kept.
+    lon0s = np.arange(lonmin, lonmax - tile_size[0] + 1e-9, tile_step[0])
+    lat0s = np.arange(latmin, latmax - tile_size[1] + 1e-9, tile_step[1])
+    return [
+        (
+            f"r{i:02d}c{j:02d}",
+            tuple(
+                round(float(e), 6)
+                for e in (lon0, lon0 + tile_size[0], lat0, lat0 + tile_size[1])
+            ),
+        )
+        for i, lat0 in enumerate(lat0s)
+        for j, lon0 in enumerate(lon0s)
+    ]
+
+
+def random_tiles(extent, tile_size, n_tiles, rng):
+    """`n_tiles` (name, extent) tiles of tile_size placed uniformly inside `extent`, named rand<k>."""
+    lonmin, lonmax, latmin, latmax = extent
+    lon0s = rng.uniform(lonmin, lonmax - tile_size[0], n_tiles)
+    lat0s = rng.uniform(latmin, latmax - tile_size[1], n_tiles)
+    return [
+        (
+            f"rand{k:03d}",
+            tuple(
+                round(float(e), 4)
+                for e in (lon0, lon0 + tile_size[0], lat0, lat0 + tile_size[1])
+            ),
+        )
+        for k, (lon0, lat0) in enumerate(zip(lon0s, lat0s))
+    ]
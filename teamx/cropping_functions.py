@@ -0,0 +1,63 @@
+import numpy as np
+
+
+def _sorted_bounds(coord, lo, hi, dim_name):
+    """
+    Inclusive index slice of the values of 1-D `coord` inside [lo, hi].
+
+    `coord` must be monotonic; descending coordinates are searched reversed,
+    so the slice selects the same cells for either orientation.
+    """
+    coord = np.asarray(coord)
+    lo, hi = min(lo, hi), max(lo, hi)
+    if coord.size < 2 or coord[-1] >= coord[0]:
+        if coord.size > 1 and np.any(np.diff(coord) < 0):
+            raise ValueError(f"Coordinate '{dim_name}' is not monotonic")
+        return slice(int(np.searchsorted(coord, lo, side='left')), int(np.searchsorted(coord, hi, side='right')))
+
+    rev = coord[::-1]
+    if np.any(np.diff(rev) < 0):
+        raise ValueError(f"Coordinate '{dim_name}' is not monotonic")
+    start = int(np.searchsorted(rev, lo, side='left'))
+    stop = int(np.searchsorted(rev, hi, side='right'))
+    return slice(coord.size - stop, coord.size - start)
+
+
+def domain_slices(lon, lat, extent):
+    """
+    (lat_slice, lon_slice) integer slices of `extent` = (lonmin, lonmax, latmin, latmax)
+    on sorted 1-D lon/lat coordinates, bounds included.
+
+    The slices only depend on the grid, so they are computed once per day and
+    reused for every timestamp; an extent outside the grid gives empty slices.
+    """
+    lonmin, lonmax, latmin, latmax = extent
+    return _sorted_bounds(lat, latmin, latmax, 'lat'), _sorted_bounds(lon, lonmin, lonmax, 'lon')
+
+
+def time_index(times, timestamp):
+    """Position of `timestamp` in the sorted `times` coordinate; KeyError if it is not present."""
+    times = np.asarray(times)
+    t = np.asarray(timestamp, dtype=times.dtype)
+    idx = int(np.searchsorted(times, t, side='left'))
+    if idx == times.size or times[idx] != t:
+        raise KeyError(f"Timestamp {timestamp} not found")
+    return idx
+
+
+def filter_by_domain(ds, extent, slices=None):
+    """
+    Crop `ds` to `extent` = (lonmin, lonmax, latmin, latmax) by position.
+
+    Pass `slices` from domain_slices to skip the coordinate search when the
+    same extent is cut from many timestamps of one grid.
+    """
+    if slices is None:
+        slices = domain_slices(ds['lon'].values, ds['lat'].values, extent)
+    lat_slice, lon_slice = slices
+    return ds.isel(lat=lat_slice, lon=lon_slice)
+
+
+def filter_by_time(ds, timestamp):
+    """Select the single time step `timestamp` of `ds` by position (time dim dropped, as with sel)."""
+    return ds.isel(time=time_index(ds['time'].values, timestamp))
@@ -0,0 +1,92 @@
+import os
+
+# Compression of the merged day files unless overridden (the historical setting).
+DEFAULT_CODEC = 'zlib'
+DEFAULT_COMPLEVEL = 9
+DEFAULT_SHUFFLE = True
+# Time-slice chunks: the crop generator reads one timestamp over one crop extent
+# at a time, so a chunk holds one time step of a 256x256 tile (256 KiB of float32,
+# ~1.3 deg at 500 m) and an hourly 4x4 deg crop decompresses only the ~16 tiles it
+# touches instead of whole frames.
+DEFAULT_CHUNKS = 'time=1,lat=256,lon=256'
+
+CODECS = ('none', 'zlib', 'zstd', 'bzip2', 'szip', 'blosc_lz4', 'blosc_lz', 'blosc_zlib', 'blosc_zstd')
+
+
+def parse_chunks(spec):
+    """
+    Parse a chunk spec 'time=1,lat=256,lon=256' into {dim: size}.
+    Dims left out are stored whole; an empty spec leaves chunking to the library.
+    """
+    chunks = {}
+    for part in (spec or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        dim, _, size = part.partition('=')
+        if not size:
+            raise ValueError(f"Chunk spec entries must be dim=size, got '{part}'")
+        chunks[dim.strip()] = int(size)
+    return chunks
+
+
+def compression_options(codec=DEFAULT_CODEC, complevel=DEFAULT_COMPLEVEL, shuffle=DEFAULT_SHUFFLE,
+                        chunks=DEFAULT_CHUNKS):
+    """
+    Validated compression options: codec, complevel, shuffle and chunks ({dim: size}).
+    chunks=None or '' leaves the chunk shape to the netCDF library.
+    """
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec '{codec}', expected one of {CODECS}")
+    if isinstance(chunks, str):
+        chunks = parse_chunks(chunks)
+    return {'codec': codec, 'complevel': int(complevel), 'shuffle': bool(shuffle), 'chunks': chunks or {}}
+
+
+def compression_options_from_env(prefix='MERGE', chunks=DEFAULT_CHUNKS):
+    """
+    compression_options from environment variables, so the merge scripts keep
+    their positional command lines: <prefix>_CODEC, <prefix>_COMPLEVEL,
+    <prefix>_SHUFFLE (0/1) and <prefix>_CHUNKS (e.g. 'time=1,lat=256,lon=256';
+    set it empty for library chunking). `chunks` is the default of <prefix>_CHUNKS.
+    An unknown codec raises ValueError here, before anything is written.
+    """
+    return compression_options(
+        codec=os.environ.get(f"{prefix}_CODEC", DEFAULT_CODEC),
+        complevel=os.environ.get(f"{prefix}_COMPLEVEL", DEFAULT_COMPLEVEL),
+        shuffle=os.environ.get(f"{prefix}_SHUFFLE", '1') != '0',
+        chunks=os.environ.get(f"{prefix}_CHUNKS", chunks),
+    )
+
+
+def describe(options):
+    """Short label of compression options, e.g. 'zlib level 4, shuffle, chunks time=1,lat=256'."""
+    if options['codec'] == 'none':
+        label = 'no compression'
+    else:
+        label = f"{options['codec']} level {options['complevel']}" + (', shuffle' if options['shuffle'] else '')
+    if options['chunks']:
+        label += ', chunks ' + ','.join(f"{dim}={size}" for dim, size in options['chunks'].items())
+    return label
+
+
+def variable_encoding(da, options):
+    """netCDF4-backend encoding of one variable for the given compression options."""
+    encoding = {}
+    if options['codec'] == 'zlib':
+        encoding.update(zlib=True, complevel=options['complevel'], shuffle=options['shuffle'])
+    elif options['codec'] != 'none':
+        encoding.update(compression=options['codec'], complevel=options['complevel'], shuffle=options['shuffle'])
+    chunks = options['chunks']
+    if chunks and da.ndim:
+        encoding['chunksizes'] = tuple(
+            # An empty (unlimited) dim being created for appends gets 1 unless given.
+            max(1, min(chunks.get(dim, size), size)) if size else chunks.get(dim, 1)
+            for dim, size in zip(da.dims, da.shape)
+        )
+    return encoding
+
+
+def dataset_encoding(ds, options):
+    """variable_encoding for every data variable of `ds`."""
+    return {var: variable_encoding(ds[var], options) for var in ds.data_vars}
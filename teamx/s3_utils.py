@@ -0,0 +1,171 @@
+import io
+import os
+import time
+import hashlib
+from collections import OrderedDict
+
+
+class S3RangeFile(io.RawIOBase):
+    """
+    Read-only, seekable file object over an S3 object using HTTP range requests.
+
+    Data is fetched in fixed-size blocks kept in a small LRU cache, so readers
+    such as h5netcdf/h5py only download the blocks holding the metadata,
+    variables and hyperslabs they actually touch. Every range request is pinned
+    to the ETag seen at open time, so a concurrent overwrite fails loudly
+    instead of mixing two versions of the file.
+    """
+
+    def __init__(self, s3, bucket, key, block_size=4 * 1024**2, max_blocks=16):
+        super().__init__()
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.block_size = int(block_size)
+        self.max_blocks = max(1, int(max_blocks))
+
+        head = s3.head_object(Bucket=bucket, Key=key)
+        self.size = int(head['ContentLength'])
+        self.etag = head.get('ETag')
+
+        self._pos = 0
+        self._blocks = OrderedDict()
+        self.bytes_fetched = 0
+        self.n_requests = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if pos < 0:
+            raise ValueError(f"Negative seek position: {pos}")
+        self._pos = pos
+        return self._pos
+
+    def _get_block(self, block_idx):
+        block = self._blocks.get(block_idx)
+        if block is not None:
+            self._blocks.move_to_end(block_idx)
+            return block
+
+        start = block_idx * self.block_size
+        end = min(start + self.block_size, self.size) - 1
+        kwargs = {'Bucket': self.bucket, 'Key': self.key, 'Range': f"bytes={start}-{end}"}
+        if self.etag:
+            kwargs['IfMatch'] = self.etag
+        block = self.s3.get_object(**kwargs)['Body'].read()
+        self.bytes_fetched += len(block)
+        self.n_requests += 1
+
+        self._blocks[block_idx] = block
+        if len(self._blocks) > self.max_blocks:
+            self._blocks.popitem(last=False)
+        return block
+
+    def readinto(self, buffer):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        view = memoryview(buffer).cast('B')
+        n_wanted = min(len(view), max(0, self.size - self._pos))
+        n_done = 0
+        while n_done < n_wanted:
+            block_idx, offset = divmod(self._pos, self.block_size)
+            block = self._get_block(block_idx)
+            chunk = block[offset:offset + (n_wanted - n_done)]
+            if not chunk:
+                break
+            view[n_done:n_done + len(chunk)] = chunk
+            n_done += len(chunk)
+            self._pos += len(chunk)
+        return n_done
+
+    def close(self):
+        self._blocks.clear()
+        super().close()
+
+
+class LocalObjectCache:
+    """
+    On-disk content cache for bucket objects, keyed by bucket/key/ETag.
+
+    A HEAD request resolves the current ETag; if that version is already on
+    disk it is served locally, otherwise it is downloaded once. Entries are
+    evicted least-recently-used first (by access time, refreshed on every hit)
+    whenever the total size exceeds `max_bytes`. Files are written under a
+    temporary name and renamed, so concurrent workers can share one cache.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_bytes)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_path(self, bucket, key, etag):
+        digest = hashlib.sha1(f"{bucket}/{key}/{etag}".encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}{os.path.splitext(key)[1]}")
+
+    def get_path(self, s3, bucket, key):
+        """Return a local path holding the current version of s3://bucket/key."""
+        etag = s3.head_object(Bucket=bucket, Key=key).get('ETag', '')
+        path = self._entry_path(bucket, key, etag)
+
+        if os.path.exists(path):
+            now = time.time()
+            os.utime(path, (now, now))
+            return path
+
+        tmp_path = f"{path}.{os.getpid()}.part"
+        try:
+            kwargs = {'Bucket': bucket, 'Key': key}
+            if etag:
+                kwargs['IfMatch'] = etag
+            body = s3.get_object(**kwargs)['Body']
+            with open(tmp_path, 'wb') as f:
+                for chunk in iter(lambda: body.read(8 * 1024**2), b''):
+                    f.write(chunk)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        """Delete least-recently-used entries until the cache fits in max_bytes."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.part'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
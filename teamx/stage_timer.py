@@ -0,0 +1,110 @@
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class StageTimer:
+    """
+    Per-day, per-stage wall time / byte / item counters for the crop pipeline.
+
+    Calls to `stage` are accumulated per (day, source, stage); `flush(day)`
+    appends the records of that day as JSON lines to `trace_path`. Each worker
+    process can own a StageTimer on the same trace file. With trace_path=None
+    the timer is disabled and `stage` only hands out a throwaway counter dict.
+    """
+
+    def __init__(self, trace_path=None):
+        self.trace_path = trace_path
+        self._lock = threading.Lock()
+        self._records = {}
+
+    @property
+    def enabled(self):
+        return self.trace_path is not None
+
+    @contextmanager
+    def stage(self, stage, day, source=None):
+        """Time a block; the yielded dict takes 'bytes' and 'items' counts."""
+        counters = {'bytes': 0, 'items': 0}
+        if not self.enabled:
+            yield counters
+            return
+        t0 = time.perf_counter()
+        try:
+            yield counters
+        finally:
+            self.add(stage, day, source, time.perf_counter() - t0, counters['bytes'], counters['items'])
+
+    def add(self, stage, day, source=None, seconds=0.0, n_bytes=0, items=0):
+        """Add an already measured amount to a stage record."""
+        if not self.enabled:
+            return
+        with self._lock:
+            rec = self._records.setdefault(
+                (day, source, stage),
+                {'day': day, 'source': source, 'stage': stage, 'seconds': 0.0, 'bytes': 0, 'items': 0, 'calls': 0},
+            )
+            rec['seconds'] += seconds
+            rec['bytes'] += int(n_bytes)
+            rec['items'] += int(items)
+            rec['calls'] += 1
+
+    def flush(self, day):
+        """Append the records of `day` to the trace file and forget them."""
+        if not self.enabled:
+            return
+        with self._lock:
+            keys = [k for k in self._records if k[0] == day]
+            records = [self._records.pop(k) for k in keys]
+        if not records:
+            return
+        lines = ''.join(json.dumps(rec) + '\n' for rec in records)
+        # One write per day keeps lines from concurrent workers intact.
+        with open(self.trace_path, 'a', encoding='utf-8') as f:
+            f.write(lines)
+
+
+def load_trace(trace_path):
+    with open(trace_path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize_trace(records):
+    """Aggregate per-day records into one row per (source, stage) with p50/p95 of the per-day times."""
+    groups = {}
+    for rec in records:
+        groups.setdefault((rec['source'] or '-', rec['stage']), []).append(rec)
+
+    rows = []
+    for (source, stage), recs in sorted(groups.items()):
+        seconds = np.array([r['seconds'] for r in recs])
+        rows.append({
+            'source': source,
+            'stage': stage,
+            'days': len(recs),
+            'total_s': float(seconds.sum()),
+            'p50_s': float(np.percentile(seconds, 50)),
+            'p95_s': float(np.percentile(seconds, 95)),
+            'total_mb': sum(r['bytes'] for r in recs) / 1024**2,
+            'items': sum(r['items'] for r in recs),
+        })
+    return rows
+
+
+def print_trace_summary(trace_path):
+    """Print the end-of-run stage table for a JSON-lines trace."""
+    rows = summarize_trace(load_trace(trace_path))
+    print()
+    print("=" * 86)
+    print("Stage timing (per day)")
+    print("=" * 86)
+    print(f"{'source':<7} {'stage':<12} {'days':>6} {'total [s]':>11} {'p50 [s]':>9} {'p95 [s]':>9} {'MB':>11} {'items':>9}")
+    for r in rows:
+        print(
+            f"{r['source']:<7} {r['stage']:<12} {r['days']:>6} {r['total_s']:>11.1f} "
+            f"{r['p50_s']:>9.2f} {r['p95_s']:>9.2f} {r['total_mb']:>11.1f} {r['items']:>9}"
+        )
+    print(f"trace: {trace_path}")